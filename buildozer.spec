@@ -37,7 +37,7 @@ version = 0.1
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy,trio==0.23.2,androidstorage4kivy,attrs,sniffio,outcome,sortedcontainers
+requirements = python3,kivy,trio==0.23.2,androidstorage4kivy,pillow,attrs,sniffio,outcome,sortedcontainers
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -1,36 +1,113 @@
 import logging
+from contextlib import aclosing
 from datetime import datetime
 from io import BytesIO
+from math import ceil
+from socket import (AF_INET, IP_ADD_MEMBERSHIP, IPPROTO_IP, SO_RCVBUF, SO_REUSEADDR, SOCK_DGRAM,
+                    SOL_SOCKET, inet_aton)
+from time import perf_counter, time
 
 import trio
 from kivy.app import App
-from kivy.core.image import ImageLoader
 from kivy.graphics.texture import Texture
-from kivy.properties import (BooleanProperty, ColorProperty, ObjectProperty,
-                             StringProperty)
+from kivy.properties import (BooleanProperty, ColorProperty, ListProperty, NumericProperty,
+                             ObjectProperty, StringProperty)
 from kivy.uix.image import Image
+from libs.protocol import (FLAG_DELTA, FLAG_KEYFRAME, FrameAssembler, FrameReader, hello,
+                           unpack_tiles)
+from PIL import Image as PILImage
+
+
+def decode(frame, size):
+    "JPEG to raw RGB in a worker thread, scaled down while decoding when it is larger"
+    image = PILImage.open(BytesIO(frame))
+    image.draft('RGB', size)
+    image = image.convert('RGB')
+
+    return image.size, image.tobytes()
+
+
+def decode_tiles(frame, reduce):
+    "The tiles of a delta frame as raw RGB, reduced like the keyframe they patch"
+    patches = []
+
+    for x, y, data in unpack_tiles(frame)[1]:
+        image = PILImage.open(BytesIO(data))
+        image.draft('RGB', (ceil(image.width / reduce), ceil(image.height / reduce)))
+        image = image.convert('RGB')
+        patches.append(((x // reduce, y // reduce), image.size, image.tobytes()))
+
+    return patches
 
 
 class Stream(Image):
+    # The source of a server with several cameras, its first one when empty
+    camera = StringProperty()
     color = ColorProperty((0, 0, 0, 1))
+    decode_time = NumericProperty()
+    dropped_frames = NumericProperty()
     fit_mode = StringProperty('cover')
     frame = ObjectProperty()
+    header = ObjectProperty(None, allownone=True)
+    latency = NumericProperty()
+    # Frames of the multicast group that never arrived complete
+    lost_frames = NumericProperty()
+    # Group, port and optionally the interface to receive multicast on, empty for TCP
+    multicast = ListProperty()
     nocache = BooleanProperty(True)
+    receive_fps = NumericProperty()
+    rendition = StringProperty()
+    # Fractions of the scene (x, y, width, height) cropped by the server, empty for all
+    roi = ListProperty()
+    smoothing = NumericProperty(.1)
     streamable = BooleanProperty(False)
+    # Keyframes and the changed tiles in between, for scenes that are mostly still
+    tiles = BooleanProperty(False)
 
     def on_kv_post(self, _):
+        self._stream_texture = None
+        self._keyframe = None
+        self._shown = None
+        self._latest = None
+        self._arrival = None
+        self._ready = trio.Event()
+        self._receiving = None
+        self._restart = False
         self._app = App.get_running_app()
         self._nursery = self._app._nursery
         self._app.bind(monitor_is_off=self.monitor_status)
 
     def monitor_status(self, _, monitor_is_off):
+        "Nothing is received or decoded while the monitor is off"
         if not monitor_is_off:
             self._nursery.start_soon(self.connection)
+        elif self._receiving is not None:
+            self._receiving.cancel()
 
-    async def connection(self):
-        texture = Texture.create(size=(1, 1))
-        texture.blit_buffer(bytes([0, 0, 0, 0]), colorfmt='rgba', bufferfmt='ubyte')
-        self.texture, self.color = texture, (0, 0, 0, 1)
+    def on_roi(self, *largs):
+        "A new region needs a new hello, the last frame stays on screen meanwhile"
+        if self.streamable and self._receiving is not None:
+            self._restart = True
+            self._receiving.cancel()
+
+    def request(self):
+        "The hello of the stream, the region comes at the size it is shown in"
+        request = dict(size=self.rendition)
+
+        if self.camera:
+            request['source'] = self.camera
+        if self.tiles:
+            request['tiles'] = True
+        if self.roi:
+            request.update(roi=list(self.roi), resolution=[int(self.width), int(self.height)])
+
+        return hello(**request)
+
+    async def connection(self, restart=False):
+        if not restart:
+            texture = Texture.create(size=(1, 1))
+            texture.blit_buffer(bytes([0, 0, 0, 0]), colorfmt='rgba', bufferfmt='ubyte')
+            self.texture, self.color = texture, (0, 0, 0, 1)
 
         try:
             if self._app.monitor_is_off:
@@ -38,43 +115,185 @@ class Stream(Image):
 
                 return
 
-            client_stream = await trio.open_tcp_stream(*self.host)
-            self._nursery.start_soon(self.receiver, client_stream)
+            if self.multicast:
+                self._nursery.start_soon(self.listener, await self.join())
+            else:
+                client_stream = await trio.open_tcp_stream(*self.host)
+                self._nursery.start_soon(self.receiver, client_stream)
 
         except Exception:
             logging.warning("[%s] Couldn't connect to %s on port %s",
-                            datetime.now(), *self.host)
+                            datetime.now(), *(self.multicast[:2] or self.host))
             await trio.sleep(5)
             self._nursery.start_soon(self.connection)
 
+    async def join(self):
+        "A UDP socket in the multicast group"
+        group, port, *interface = self.multicast
+        sock = trio.socket.socket(AF_INET, SOCK_DGRAM)
+
+        try:
+            # Several displays on one host share the port
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 21)
+            await sock.bind(('', port))
+            sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP,
+                            inet_aton(group) + inet_aton(interface[0] if interface else '0.0.0.0'))
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    def _average(self, name, value):
+        "Exponential moving average of a statistic, the first sample starts it"
+        current = getattr(self, name)
+        setattr(self, name, value if not current else current + self.smoothing * (value - current))
+
     async def receiver(self, client_stream):
         async with client_stream:
             logging.debug("[%s] Connected to %s on port %s", datetime.now(), *self.host)
-            from_memory_texture = next(ldr for ldr in ImageLoader.loaders if ldr.can_load_memory())
-            frame_ending = b'\xff\xd9'
-            frame_start = b'\xff\xd8'
-            length_ending = len(frame_ending)
-            bytesio_memory = BytesIO()
-            self.color = (1, 1, 1, 1)
-            self.streamable = True
-            image_content = b''
-
-            while self.streamable and not self._app.monitor_is_off and (data := await client_stream.receive_some(4096)):
-                image_content += data
-                complete_frame_start = image_content.find(frame_start)
-                complete_frame_end = image_content.find(frame_ending)
-
-                if complete_frame_start != -1 and complete_frame_end != -1:
-                    self.frame = frame = image_content[complete_frame_start:complete_frame_end+length_ending]
-                    bytesio_memory.write(frame)
-                    bytesio_memory.seek(0)
-                    self.texture = from_memory_texture('__inline__', ext='jpg', rawdata=bytesio_memory,
-                                                       inline=True, nocache=True, mipmap=False,
-                                                       keep_data=False).texture
-                    bytesio_memory.seek(0)
-                    image_content = image_content[complete_frame_end+length_ending:]
-
-        if not hasattr(self, 'remote'):
+            await client_stream.send_all(self.request())
+            await self.present_frames(self.stream_frames(client_stream))
+
+        await self.reconnect()
+
+    async def listener(self, sock):
+        with sock:
+            logging.debug("[%s] Joined %s on port %s", datetime.now(), *self.multicast[:2])
+            await self.present_frames(self.datagram_frames(sock))
+
+        await self.reconnect()
+
+    async def stream_frames(self, client_stream):
+        frame_reader = FrameReader()
+
+        while data := await client_stream.receive_some(1 << 16):
+            frame_reader.feed(data)
+
+            for header, payload in frame_reader.frames():
+                yield header, bytes(payload)
+
+    async def datagram_frames(self, sock, timeout=5):
+        "The complete frames of the multicast group, until it has been silent for a while"
+        assembler = FrameAssembler()
+
+        while True:
+            datagram = None
+            with trio.move_on_after(timeout):
+                datagram = await sock.recv(1 << 16)
+
+            if datagram is None:
+                return
+
+            # Yielded outside of the cancel scope
+            if (frame := assembler.feed(datagram)) is not None:
+                self.lost_frames = assembler.dropped
+                header, payload = frame
+                yield header, bytes(payload)
+
+    async def present_frames(self, frames):
+        "Hands the frames of a connection to the presenter until it ends"
+        self.color = (1, 1, 1, 1)
+        self.streamable = True
+        self._latest, self._arrival, self._ready = None, None, trio.Event()
+        self._keyframe = self._shown = None
+        self.dropped_frames = self.receive_fps = self.decode_time = self.latency = 0
+        self.lost_frames = 0
+
+        async with trio.open_nursery() as nursery, aclosing(frames):
+            self._receiving = nursery.cancel_scope
+            nursery.start_soon(self.presenter)
+
+            try:
+                async for header, payload in frames:
+                    if not self.streamable or self._app.monitor_is_off:
+                        break
+                    self.received(header, payload)
+            except ValueError as error:
+                logging.warning("[%s] Dropping the stream from %s: %s", datetime.now(), self.host[0], error)
+
+            nursery.cancel_scope.cancel()
+
+        self._receiving = None
+
+    async def reconnect(self):
+        if self._restart:
+            self._restart = False
+            self._nursery.start_soon(self.connection, True)
+        elif not hasattr(self, 'remote'):
             self.streamable = False
+
+            # Connected again once the monitor is back on
+            if self._app.monitor_is_off:
+                return
+
             await trio.sleep(2)
             self._nursery.start_soon(self.connection)
+
+    def received(self, header, frame):
+        "Only the newest frame waits for decoding, the one it replaces counts as dropped"
+        arrival = perf_counter()
+
+        if self._arrival is not None and arrival > self._arrival:
+            self._average('receive_fps', 1 / (arrival - self._arrival))
+        self._arrival = arrival
+
+        if self._latest is not None:
+            self.dropped_frames += 1
+
+        if header.flags & FLAG_KEYFRAME:
+            # Kept apart, the deltas after it only patch it
+            if self._keyframe is not None:
+                self.dropped_frames += 1
+            self._keyframe, self._latest = (header, frame, time()), None
+        else:
+            self._latest = header, frame, time()
+        self._ready.set()
+        self.frame = frame
+        self.header = header
+
+    async def presenter(self):
+        "Decodes the newest frame whenever the previous one is on screen, keyframes first"
+        while True:
+            await self._ready.wait()
+            self._ready = trio.Event()
+            pending = [latest for latest in (self._keyframe, self._latest) if latest is not None]
+            self._keyframe = self._latest = None
+            start = perf_counter()
+
+            for header, frame, arrival in pending:
+                await self.present(header, frame)
+
+            self._average('decode_time', perf_counter() - start)
+            # Server timestamps make it glass to glass, else it starts at the arrival
+            self._average('latency', time() - (header.timestamp or arrival))
+
+    async def present(self, header, frame):
+        if not header.flags & FLAG_DELTA:
+            self.show(*await trio.to_thread.run_sync(decode, frame, tuple(map(int, self.size))))
+            self._shown = header
+        elif self._shown is not None and unpack_tiles(frame)[0] == self._shown.timestamp:
+            # Tiles are decoded at the scale the keyframe was decoded at
+            reduce = round(self._shown.width / self._stream_texture.width)
+            self.patch(await trio.to_thread.run_sync(decode_tiles, frame, reduce))
+
+    def patch(self, patches):
+        "Uploads the changed tiles into the texture of their keyframe"
+        for pos, size, pixels in patches:
+            self._stream_texture.blit_buffer(pixels, size=size, colorfmt='rgb',
+                                             bufferfmt='ubyte', pos=pos)
+
+        self.canvas.ask_update()
+
+    def show(self, size, pixels):
+        "Only the upload happens on the UI thread, into a texture kept between frames"
+        if self._stream_texture is None or self._stream_texture.size != size:
+            self._stream_texture = Texture.create(size=size, colorfmt='rgb')
+            self._stream_texture.flip_vertical()
+
+        self._stream_texture.blit_buffer(pixels, colorfmt='rgb', bufferfmt='ubyte')
+
+        if self.texture is not self._stream_texture:
+            self.texture = self._stream_texture
+        self.canvas.ask_update()
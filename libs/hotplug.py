@@ -0,0 +1,71 @@
+import logging
+import socket
+from glob import glob
+
+import trio
+
+__all__ = ('STATUS', 'connected', 'displays')
+
+STATUS = '/sys/class/drm/card*/*HDMI*/status'
+# Not in the socket module, the protocol of kernel uevents from linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def connected(pattern=STATUS):
+    "Whether a display is plugged into any HDMI port, true when there is no port to ask"
+    statuses = glob(pattern)
+
+    for status in statuses:
+        try:
+            with open(status, encoding='utf-8') as f:
+                if f.read().strip() == 'connected':
+                    return True
+        except OSError:
+            continue
+
+    return not statuses
+
+
+async def uevents():
+    "A socket of the kernel uevents, None where netlink is not available"
+    try:
+        sock = trio.socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    except (AttributeError, OSError) as error:
+        logging.info("No uevents (%s), polling the displays instead", error)
+        return None
+
+    try:
+        # The multicast group of the kernel, not the one udev forwards to
+        await sock.bind((0, 1))
+    except OSError as error:
+        sock.close()
+        logging.info("No uevents (%s), polling the displays instead", error)
+        return None
+
+    return sock
+
+
+async def displays(pattern=STATUS, interval=1., recheck=60.):
+    "Yields whether a display is connected, first right away and then on every change"
+    state = connected(pattern)
+    yield state
+
+    if (sock := await uevents()) is None:
+        # Reading the status files costs next to nothing
+        while True:
+            await trio.sleep(interval)
+            if (current := connected(pattern)) != state:
+                state = current
+                yield state
+
+    with sock:
+        while True:
+            with trio.move_on_after(recheck):
+                while b'SUBSYSTEM=drm' not in (await sock.recv(1 << 16)).split(b'\0'):
+                    pass
+                # A hotplug comes with a burst of events, the status settles meanwhile
+                await trio.sleep(.2)
+
+            if (current := connected(pattern)) != state:
+                state = current
+                yield state
@@ -1,13 +1,18 @@
+import logging
 import subprocess
 from datetime import datetime
 from importlib.util import find_spec
+from io import BytesIO
 from os import makedirs
 from os.path import join
+from time import time
 
 import trio
 from kivy.app import App
-from kivy.properties import ObjectProperty
+from kivy.properties import BooleanProperty, NumericProperty, ObjectProperty
 from kivy.utils import platform
+from libs.protocol import FLAG_DELTA, FLAG_KEYFRAME, unpack_tiles
+from PIL import Image as PILImage
 
 __all__ = ('SharedImage', 'SharedVideo')
 
@@ -43,6 +48,23 @@ else:
         DIRECTORY_PICTURES = 2
 
 
+def opened(frame):
+    return PILImage.open(BytesIO(frame)).convert('RGB')
+
+
+def composed(keyframe, frame):
+    "The tiles of a delta pasted into its keyframe, a whole JPEG again for ffmpeg"
+    image = keyframe.copy()
+
+    for x, y, data in unpack_tiles(frame)[1]:
+        image.paste(opened(data), (x, y))
+
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=90)
+
+    return output.getvalue()
+
+
 class ShareBase:
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -85,38 +107,94 @@ class SharedImage(ShareBase):
 
 
 class SharedVideo(ShareBase):
+    buffered_frames = NumericProperty(30)
+    dropped_frames = NumericProperty()
+    # The timebase of the recording, frames are placed on it by their timestamps
+    fps = NumericProperty(30)
+    transcode = BooleanProperty(False)
+
     def on_state(self, _: object, state: str):
         if state == 'down':
+            self._frames, self._pending = trio.open_memory_channel(self.buffered_frames)
             trio.lowlevel.spawn_system_task(self.recorder)
             self.opacity = .5
             return
-        self.record = False
+        self._frames.close()
         self.opacity = 1.
 
-    async def ffmpeg_process(self):
-        filepath = getattr(self, platform + '_path')('.mp4')
+    def queue_frame(self, stream: object, header: object):
+        "Only new frames are queued, the newest ones are dropped when ffmpeg lags"
+        if header is None:
+            return
+
+        try:
+            # Older servers send no timestamps, their frames count from the arrival
+            self._frames.send_nowait((header, stream.frame, header.timestamp or time()))
+        except trio.WouldBlock:
+            self.dropped_frames += 1
+        except trio.ClosedResourceError:
+            pass
+
+    def ffmpeg_command(self, filepath: str):
+        encoding = (['-c:v', 'mpeg4', '-q:v', '3', '-pix_fmt', 'yuv420p'] if self.transcode
+                    else ['-c:v', 'copy'])
+
+        return ['ffmpeg', '-y', '-framerate', str(self.fps),
+                '-f', 'mjpeg', '-i', '-', *encoding, filepath]
+
+    async def ffmpeg_process(self, extension: str):
+        filepath = getattr(self, platform + '_path')(extension)
         stream = App.get_running_app().root.ids.stream
-        width, height = stream.texture.size
-        self.record = True
-        process = subprocess.Popen(['ffmpeg', '-y',
-                                    '-f', 'image2pipe', '-vcodec', 'mjpeg',
-                                    '-s', f'{width}x{height}', '-r', '15',
-                                    '-i', '-',
-                                    '-vcodec', 'mpeg4',
-                                    '-q:v', '3',
-                                    '-pix_fmt', 'yuv420p',
-                                    filepath], stdin=subprocess.PIPE)
-        while self.record:
-            process.stdin.write(stream.frame)
-            await trio.sleep(.01)
-
-        process.stdin.close()
-        process.wait()
+        process = await trio.lowlevel.open_process(self.ffmpeg_command(filepath),
+                                                   stdin=subprocess.PIPE)
+        self.dropped_frames = 0
+        stream.bind(header=self.queue_frame)
+        keyframe = start = previous = None
+        written = 0
+
+        try:
+            async with self._pending:
+                async for header, frame, timestamp in self._pending:
+                    # Tiled streams are recorded as the pictures they add up to
+                    if header.flags & FLAG_KEYFRAME:
+                        keyframe = header.timestamp, await trio.to_thread.run_sync(opened, frame)
+                    elif header.flags & FLAG_DELTA and (
+                            keyframe is None or unpack_tiles(frame)[0] != keyframe[0]):
+                        self.dropped_frames += 1
+                        continue
+
+                    # A frame buffered while ffmpeg lagged keeps its own time, not its arrival
+                    start = timestamp if start is None else start
+                    if (position := round((timestamp - start) * self.fps)) < written:
+                        continue
+
+                    if header.flags & FLAG_DELTA:
+                        frame = await trio.to_thread.run_sync(composed, keyframe[1], frame)
+
+                    # Gaps hold the frame before, like the recordings of the server
+                    while written < position:
+                        await process.stdin.send_all(previous)
+                        written += 1
+
+                    await process.stdin.send_all(frame)
+                    previous, written = frame, written + 1
+        finally:
+            stream.unbind(header=self.queue_frame)
+            self._frames.close()
+            await process.stdin.aclose()
+            await process.wait()
 
         return filepath
 
     async def recorder(self):
-        filepath = await self.ffmpeg_process()
+        extension = '.mp4' if self.transcode else '.mkv'
+
+        try:
+            filepath = await self.ffmpeg_process(extension)
+        except (OSError, trio.BrokenResourceError) as error:
+            logging.error("Couldn't record the stream: %s", error)
+            return
+
         share = getattr(self, platform + '_share')
         share(filepath, Environment.DIRECTORY_MOVIES,
-              '"video/.mp4"', "Gör videon redo för delning")
+              f'"video/{extension}"', "Gör videon redo för delning")
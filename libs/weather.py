@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+from os.path import basename, dirname, isfile, join
+from time import time
+
+from httpx import AsyncClient, HTTPError, HTTPStatusError, Limits
+
+__all__ = ('WeatherService', )
+
+# httpx logs the URL of every request, the API key is one of its parameters
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+
+def max_age(response, default):
+    "Seconds the response stays fresh, from its Cache-Control when it has one"
+    for directive in response.headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+
+        if name == 'max-age' and value.isdigit():
+            return int(value)
+
+    return default
+
+
+def reason(error):
+    "Why a request failed, without the URL of its message and the API key in it"
+    if isinstance(error, HTTPStatusError):
+        return f'HTTP {error.response.status_code}'
+
+    return error.__class__.__name__ if isinstance(error, HTTPError) else repr(error)
+
+
+def store(path, data):
+    "Replaces the file at once, a kiosk losing power never leaves half of it"
+    os.makedirs(dirname(path), exist_ok=True)
+
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(data)
+
+    os.replace(f'{path}.tmp', path)
+
+
+class WeatherService:
+    "The current weather and its icons through one pooled client, cached on disk"
+
+    def __init__(self, key, coordinates, url, icon_url, cache='cache', ttl=1800, timeout=10):
+        lat, lon = coordinates
+        self.params = dict(lat=lat, lon=lon, appid=key, units='metric',
+                           exclude='minutely,hourly,daily,alerts')
+        self.url = url
+        self.icon_url = icon_url
+        self.cache = cache
+        self.ttl = ttl
+        self.client = AsyncClient(timeout=timeout, follow_redirects=True,
+                                  limits=Limits(max_connections=2, max_keepalive_connections=2))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *largs):
+        await self.client.aclose()
+
+    def _cached(self):
+        try:
+            with open(join(self.cache, 'weather.json'), encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Another place, or another source, is not a report for this one
+        return cached if cached.get('request') == [self.url, self.params['lat'],
+                                                    self.params['lon']] else None
+
+    async def current(self):
+        "The temperature and icon code and whether they are fresh, stale ones when the fetch fails"
+        cached = self._cached()
+
+        if cached is not None and cached['expires'] > time():
+            return cached['current'], True
+
+        try:
+            response = await self.client.get(self.url, params=self.params)
+            response.raise_for_status()
+            data = response.json()['current']
+            current = dict(temp=float(data['temp']), icon=basename(data['weather'][0]['icon']))
+        except (HTTPError, ValueError, LookupError, TypeError) as error:
+            logging.error("Couldn't fetch weather data: %s", reason(error))
+
+            return (cached['current'] if cached else None), False
+
+        try:
+            store(join(self.cache, 'weather.json'), json.dumps(dict(
+                request=[self.url, self.params['lat'], self.params['lon']], current=current,
+                expires=time() + max_age(response, self.ttl))).encode())
+        except OSError as error:
+            # A read-only or full card only costs the cache, the report is still good
+            logging.error("Couldn't cache weather data: %s", error)
+
+        return current, True
+
+    async def icon(self, code):
+        "The path of the icon, downloaded once for every icon code"
+        if isfile(path := join(self.cache, 'icons', f'{code}.png')):
+            return path
+
+        try:
+            response = await self.client.get(self.icon_url.format(icon=code))
+            response.raise_for_status()
+        except HTTPError as error:
+            logging.error("Couldn't fetch the weather icon %s: %s", code, reason(error))
+
+            return None
+
+        try:
+            store(path, response.content)
+        except OSError as error:
+            # There is no file to show, the next refresh tries again
+            logging.error("Couldn't cache the weather icon %s: %s", code, error)
+
+            return None
+
+        return path
@@ -1,10 +1,13 @@
 import json
 from io import BytesIO
+from uuid import uuid4
 
 import trio
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.core.image import Image as CoreImage
 from kivy.core.window import Window
+from kivy.metrics import dp
 from kivy.network.urlrequest import UrlRequest
 from kivy.properties import (BooleanProperty, DictProperty, ListProperty,
                              NumericProperty, ObjectProperty, StringProperty)
@@ -14,19 +17,86 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.image import Image
 from kivy.uix.label import Label
 from kivy.utils import platform
+from kivy.vector import Vector
 from libs.corestreamer import Stream
 from libs.share import SharedImage, SharedVideo
 
 with open('configuration.json', encoding='utf-8') as f:
     CONFIG = json.load(f)
 
+# The lease on the feed is renewed well within the 30 seconds of the server
+CLIENT = uuid4().hex
+HEARTBEAT = 10
+
 
 class Streamer(ButtonBehavior, Stream):
     remote = ObjectProperty(None, allownone=True)
     fit_mode = StringProperty('scale-down')
     host = ListProperty(CONFIG['SERVER']['remote'])
+    zoom_limit = NumericProperty(.1)
+
+    def on_kv_post(self, _):
+        super().on_kv_post(_)
+        self._touches = {}
+        self._gesture = None
+        self._zoomed = None
+        self._gestured = False
+
+    def _spread(self):
+        "Centroid of the touches and, with two of them, the distance between them"
+        touches = list(self._touches.values())[:2]
+        x = sum(touch.x for touch in touches) / len(touches)
+        y = sum(touch.y for touch in touches) / len(touches)
+        spread = (Vector(touches[0].pos).distance(touches[1].pos)
+                  if len(touches) == 2 else None)
+
+        return x, y, spread
+
+    def on_touch_down(self, touch):
+        if self.streamable and self.collide_point(*touch.pos):
+            if not self._touches:
+                self._zoomed, self._gestured = None, False
+            self._touches[touch.uid] = touch
+            # Every change of fingers starts over from the region shown now
+            self._gesture = (list(self._zoomed or self.roi or (0, 0, 1, 1)), self._spread())
+
+        return super().on_touch_down(touch)
+
+    def on_touch_move(self, touch):
+        if touch.uid in self._touches and self._gesture is not None:
+            (x, y, w, h), (x0, y0, spread0) = self._gesture
+            x1, y1, spread = self._spread()
+            zoom = spread0 / spread if spread and spread0 else 1
+            width, height = (min(1, max(self.zoom_limit, side * zoom)) for side in (w, h))
+            # Kivy counts y upwards, the rows of the frame count downwards
+            cx = x + w / 2 - (x1 - x0) / self.width * w
+            cy = y + h / 2 + (y1 - y0) / self.height * h
+
+            if abs(x1 - x0) > dp(10) or abs(y1 - y0) > dp(10) or abs(zoom - 1) > .05:
+                self._gestured = True
+                self._zoomed = [min(max(cx - width / 2, 0), 1 - width),
+                                min(max(cy - height / 2, 0), 1 - height), width, height]
+
+        return super().on_touch_move(touch)
+
+    def on_touch_up(self, touch):
+        if self._touches.pop(touch.uid, None) is not None:
+            if self._touches:
+                self._gesture = (list(self._zoomed or self.roi or (0, 0, 1, 1)), self._spread())
+            elif self._zoomed is not None:
+                # Released, the server sends the region from now on
+                self._gesture = None
+                self.roi = [] if self._zoomed[2] >= 1 else self._zoomed
+                self._zoomed = None
+
+        return super().on_touch_up(touch)
 
     def on_release(self):
+        # Every finger of a pinch releases the button, none of them toggles the stream
+        if self._touches or self._gestured:
+            self._gestured = bool(self._touches)
+            return
+
         if self.streamable:
             self.streamable = False
             self.fit_mode = 'scale-down'
@@ -88,6 +158,7 @@ class Controller(ButtonBehavior, Label):
     font_name = StringProperty('fonts/JosefinSans-Bold.ttf')
     remote = ObjectProperty(None, allownone=True)
     target = StringProperty()
+    heartbeat = None
 
     def on_state(self, _, state):
         self.opacity = .5 if state == 'down' else 1
@@ -95,9 +166,27 @@ class Controller(ButtonBehavior, Label):
     def on_release(self):
         url = CONFIG['SERVER']['remote'][0]
         http = CONFIG['SERVER']['http']
-        UrlRequest(f"http://{url}:{http}/{self.target}",
+        UrlRequest(f"http://{url}:{http}/{self.target}?client={CLIENT}",
                    self.schedule_info)
 
+        # Shared by the start and stop buttons, only one lease is kept alive
+        if Controller.heartbeat is not None:
+            Controller.heartbeat.cancel()
+        Controller.heartbeat = (Clock.schedule_interval(self.send_heartbeat, HEARTBEAT)
+                                if self.target == 'connect' else None)
+
+    def send_heartbeat(self, _):
+        url = CONFIG['SERVER']['remote'][0]
+        http = CONFIG['SERVER']['http']
+        UrlRequest(f"http://{url}:{http}/heartbeat?client={CLIENT}",
+                   on_failure=self.lease_lost)
+
+    def lease_lost(self, *largs):
+        if Controller.heartbeat is not None:
+            Controller.heartbeat.cancel()
+            Controller.heartbeat = None
+        self.schedule_info()
+
     def schedule_info(self, *largs):
         if self.remote is not None:
             self.remote.dispatch('on_release')
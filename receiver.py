@@ -2,13 +2,11 @@
 # coding: utf-8
 
 import json
-import logging
+from contextlib import aclosing
 from datetime import datetime
-from glob import glob
 from os.path import join
 
 import trio
-from httpx import AsyncClient
 from kivy.app import App
 from kivy.clock import Clock
 from kivy.core.window import Window
@@ -16,12 +14,16 @@ from kivy.properties import (BooleanProperty, ColorProperty, ListProperty,
                              NumericProperty, StringProperty)
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.uix.floatlayout import FloatLayout
+from libs.hotplug import displays
 from libs.lunar import lunar_phase
+from libs.weather import WeatherService
 
 with open('configuration.json', encoding='utf-8') as f:
     CONFIG = json.load(f)
 
 Window.size = CONFIG['SETTINGS']['window_size']
+# Seconds until a failed weather fetch is tried again
+WEATHER_RETRY = 5 * 60
 
 
 class Weather(AnchorLayout):
@@ -38,10 +40,19 @@ class ReceiverApp(App):
     host = ListProperty(CONFIG['SERVER']['remote'])
     icon = StringProperty(join('icons', 'snap.png'))
     monitor_is_off = BooleanProperty(None)
+    # The group and port of the server, to share its frames with the other displays
+    multicast = ListProperty(CONFIG['SERVER']['multicast'])
+    camera = StringProperty(CONFIG['SERVER']['camera'])
 
     async def async_run(self):
-        async with trio.open_nursery() as nursery:
-            Clock.schedule_interval(lambda dt: nursery.start_soon(self.check_monitor_status), 60)
+        weather_conf = CONFIG['WEATHER']
+
+        async with (WeatherService(weather_conf['key'], weather_conf['coordinates'],
+                                   weather_conf['url'], weather_conf['icon_url'],
+                                   weather_conf['cache'], weather_conf['ttl']) as self.weather,
+                    trio.open_nursery() as nursery):
+            self._weather_retry = None
+            self._timers = []
             nursery.start_soon(self.check_monitor_status)
             self._nursery = nursery
             await super().async_run(async_lib='trio')
@@ -55,24 +66,22 @@ class ReceiverApp(App):
         self.root.ids.lunar_icon.reload()
 
     async def check_weather_report(self):
-        weather_conf = CONFIG['WEATHER']
-        lat, lon = weather_conf['coordinates']
         widget_ids = self.root.ids
         weather = widget_ids.weather
+        current, fresh = await self.weather.current()
 
-        async with AsyncClient() as client:
-            try:
-                r = await client.get(f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}"
-                                     f"&appid={weather_conf['key']}&units=metric&exclude=minutely,"
-                                     "hourly,daily,alerts")
-                data = r.json()['current']
-                weather.path = f"https://openweathermap.org/img/wn/{data['weather'][0]['icon']}@2x.png"
-                weather.deg = round(data['temp'], 1)
+        if current is None:
+            weather.path = join('icons', 'na.png')
+            weather.deg = -99.9
+        else:
+            weather.path = await self.weather.icon(current['icon']) or join('icons', 'na.png')
+            weather.deg = round(current['temp'], 1)
 
-            except Exception as error:
-                logging.error("Couldn't fetch weather data: %s", error)
-                weather.path = join('icons', 'na.png')
-                weather.deg = -99.9
+        # Stale or missing, so it is tried again long before the next refresh
+        if self._weather_retry is not None:
+            self._weather_retry.cancel()
+        self._weather_retry = None if fresh else Clock.schedule_once(
+            lambda dt: self._nursery.start_soon(self.check_weather_report), WEATHER_RETRY)
 
         if 10 > weather.deg > -100:
             weather.heat = .3, .3, 1, .5
@@ -86,11 +95,10 @@ class ReceiverApp(App):
         widget_ids.weather_icon.reload()
 
     async def check_monitor_status(self):
-        for status in glob('/sys/class/drm/card*[0-1]*/*HDMI*/status'):
-            with open(status, encoding='utf-8') as f:
-                self.monitor_is_off = not f.read() == 'disconnected\n'
-        else:
-            self.monitor_is_off = False
+        "Follows the HDMI hotplug events, the dashboard only runs with a display"
+        async with aclosing(displays()) as changes:
+            async for connected in changes:
+                self.monitor_is_off = not connected
 
     def time_set(self):
         time_now = datetime.now()
@@ -98,18 +106,22 @@ class ReceiverApp(App):
         self.root.ids.time.text = time_now.strftime('%H:%M:%S')
 
     def on_monitor_is_off(self, _: object, monitor_is_off: bool):
-        if monitor_is_off:
-            Clock.unschedule(self.check_weather_report)
-            Clock.unschedule(self.check_lunar_phase)
-            Clock.unschedule(self.time_set)
+        # The events themselves, the callbacks are lambdas that unschedule cannot find
+        for timer in (*self._timers, self._weather_retry):
+            if timer is not None:
+                timer.cancel()
+        self._timers, self._weather_retry = [], None
 
+        if monitor_is_off:
             return
 
-        Clock.schedule_interval(lambda dt: self._nursery.start_soon(self.check_weather_report),
-                                                                    60 * 60 * 2)
-        Clock.schedule_interval(lambda dt: self._nursery.start_soon(self.check_lunar_phase),
-                                                                    60 * 60 * 4)
-        Clock.schedule_interval(lambda dt: self.time_set(), 1)
+        self._timers = [
+            Clock.schedule_interval(lambda dt: self._nursery.start_soon(self.check_weather_report),
+                                    60 * 60 * 2),
+            Clock.schedule_interval(lambda dt: self._nursery.start_soon(self.check_lunar_phase),
+                                    60 * 60 * 4),
+            Clock.schedule_interval(lambda dt: self.time_set(), 1)]
+        self.time_set()
         self._nursery.start_soon(self.check_weather_report)
         self._nursery.start_soon(self.check_lunar_phase)
 
@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+from os import listdir
+from socket import (AF_INET, IP_ADD_MEMBERSHIP, IPPROTO_IP, SO_RCVBUF, SO_REUSEADDR, SOCK_DGRAM,
+                    SOL_SOCKET, inet_aton)
+from statistics import quantiles
+from time import perf_counter, time
+
+import trio
+from libs.protocol import FrameAssembler, FrameReader, hello
+
+CLOCK = os.sysconf('SC_CLK_TCK')
+LOOPBACK = '127.0.0.1'
+TRANSPORTS = ('tcp', 'http', 'multicast')
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+
+def usage(pid):
+    "CPU seconds and resident memory of the process and its children, from /proc"
+    # Shared memory is counted once per process that maps it
+    pids, cpu, rss = [pid], 0., 0
+
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/stat', encoding='utf-8') as f:
+                fields = f.read().rpartition(')')[2].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK
+            rss += int(fields[21]) * PAGE
+
+            for task in listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children', encoding='utf-8') as f:
+                    pids += map(int, f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+
+    return cpu, rss
+
+
+async def http_get(host, port, path):
+    "The response body of a plain HTTP/1.0 request, read until the server closes"
+    async with await trio.open_tcp_stream(host, port) as stream:
+        await stream.send_all(f'GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.encode())
+        response = b''
+        while data := await stream.receive_some(1 << 16):
+            response += data
+
+    return response.partition(b'\r\n\r\n')[2]
+
+
+async def scrape(host, port):
+    "The metrics of the server as a dict of series and their values"
+    metrics = {}
+
+    for line in (await http_get(host, port, '/metrics')).decode().splitlines():
+        if line and not line.startswith('#'):
+            series, _, value = line.rpartition(' ')
+            metrics[series] = float(value)
+
+    return metrics
+
+
+def total(metrics, name):
+    "The sum of a metric over all of its labels"
+    return sum(value for series, value in metrics.items() if series.partition('{')[0] == name)
+
+
+class Client:
+    "Counts the frames a headless client receives and how old they are on arrival"
+
+    def __init__(self, transport, rendition, tiles=False):
+        self.transport = transport
+        self.rendition = rendition
+        self.tiles = tiles
+        self.frames = 0
+        self.latencies = []
+        self.measuring = False
+
+    def received(self, timestamp):
+        if self.measuring:
+            self.frames += 1
+            self.latencies.append(time() - timestamp)
+
+    async def tcp(self, host, port):
+        async with await trio.open_tcp_stream(host, port) as stream:
+            await stream.send_all(hello(size=self.rendition, tiles=self.tiles))
+            reader = FrameReader()
+
+            while data := await stream.receive_some(1 << 16):
+                reader.feed(data)
+
+                for header, _ in reader.frames():
+                    self.received(header.timestamp)
+
+    async def http(self, host, port):
+        "Reads the multipart stream over HTTP/1.0, so it is not chunked"
+        async with await trio.open_tcp_stream(host, port) as stream:
+            await stream.send_all(f'GET /stream?size={self.rendition} HTTP/1.0\r\n'
+                                  f'Host: {host}\r\n\r\n'.encode())
+            buffer = b''
+
+            while data := await stream.receive_some(1 << 16):
+                buffer += data
+
+                while (end := buffer.find(b'\r\n\r\n')) >= 0:
+                    headers = dict(line.partition(b':')[::2]
+                                   for line in buffer[:end].split(b'\r\n')[1:])
+                    length = int(headers.get(b'Content-Length', 0))
+
+                    if len(buffer) < end + 4 + length:
+                        break
+
+                    if b'X-Timestamp' in headers:
+                        self.received(float(headers[b'X-Timestamp']))
+                    buffer = buffer[end + 4 + length:]
+
+    async def multicast(self, group, port):
+        "Joins the group on the loopback interface, where the benchmarked server sends"
+        with trio.socket.socket(AF_INET, SOCK_DGRAM) as sock:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 21)
+            await sock.bind(('', port))
+            sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, inet_aton(group) + inet_aton(LOOPBACK))
+            assembler = FrameAssembler()
+
+            while True:
+                if (frame := assembler.feed(await sock.recv(1 << 16))) is not None:
+                    self.received(frame[0].timestamp)
+
+
+def server(overrides):
+    "The server of main.py with sections of its settings replaced, ready to run"
+    import main
+
+    for section, settings in overrides.items():
+        main.SERVER_CONFIG[section].update(settings)
+    main.feed = main.FeedStream()
+
+    return main.feed
+
+
+async def wait_for_server(host, port, timeout=30):
+    with trio.fail_after(timeout):
+        while True:
+            try:
+                await (await trio.open_tcp_stream(host, port)).aclose()
+                return
+            except OSError:
+                await trio.sleep(.2)
+
+
+async def benchmark(arguments, overrides):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configuration.json'),
+              encoding='utf-8') as f:
+        config = json.load(f)
+
+    host, port, http = LOOPBACK, config['SERVER']['host'][1], int(config['SERVER']['http'])
+    group = config['MULTICAST']['group']
+    clients = ([Client('tcp', arguments.rendition, arguments.tiles) for _ in range(arguments.tcp)]
+               + [Client('http', arguments.rendition) for _ in range(arguments.http)]
+               + [Client('multicast', arguments.rendition) for _ in range(arguments.multicast)])
+    process = None
+
+    async with trio.open_nursery() as nursery:
+        if arguments.in_process:
+            nursery.start_soon(server(overrides).run)
+            pid = os.getpid()
+        else:
+            # A session of its own, so the processes of the pipeline end with it
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve',
+                                        json.dumps(overrides)], start_new_session=True)
+            pid = process.pid
+
+        try:
+            await wait_for_server(host, http)
+            await wait_for_server(host, port)
+
+            for client in clients:
+                nursery.start_soon(getattr(client, client.transport),
+                                   *{'tcp': (host, port), 'http': (host, http)}.get(
+                                       client.transport, group))
+
+            await trio.sleep(arguments.warmup)
+            before, cpu, started = await scrape(host, http), usage(pid)[0], perf_counter()
+
+            for client in clients:
+                client.measuring = True
+
+            await trio.sleep(arguments.seconds)
+            elapsed = perf_counter() - started
+            after, (cpu_end, rss) = await scrape(host, http), usage(pid)
+
+            for client in clients:
+                client.measuring = False
+        finally:
+            nursery.cancel_scope.cancel()
+
+            if process is not None:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+
+    def rate(series):
+        return round((after.get(series, 0) - before.get(series, 0)) / elapsed, 1)
+
+    encoded = 'lindcam_encoded_frames_total'
+    report = dict(
+        seconds=round(elapsed, 2), settings=overrides,
+        capture_fps=round((total(after, 'lindcam_frames_total')
+                           - total(before, 'lindcam_frames_total')) / elapsed, 1),
+        changed_fps=rate('lindcam_frames_total{outcome="changed"}'),
+        encode_fps={series.split('"')[1]: rate(series) for series in after
+                    if series.startswith(f'{encoded}{{')},
+        sent_megabits={transport: round(rate(f'lindcam_sent_bytes_total{{transport="{transport}"}}')
+                                        * 8 / 1e6, 2) for transport in TRANSPORTS},
+        cpu_percent=round((cpu_end - cpu) / elapsed * 100, 1),
+        rss_megabytes=round(rss / (1 << 20), 1),
+        clients={})
+
+    for transport in TRANSPORTS:
+        if not (group := [client for client in clients if client.transport == transport]):
+            continue
+
+        fps = [client.frames / elapsed for client in group]
+        latencies = [latency for client in group for latency in client.latencies]
+        result = report['clients'][transport] = dict(
+            count=len(group), fps_min=round(min(fps), 1), fps_mean=round(sum(fps) / len(fps), 1))
+
+        if len(latencies) > 1:
+            percentiles = quantiles(latencies, n=100)
+            for percentile in (50, 90, 99):
+                result[f'latency_p{percentile}_ms'] = round(percentiles[percentile - 1] * 1000, 2)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the server with a synthetic camera')
+    parser.add_argument('--tcp', type=int, default=4, help='headless TCP clients')
+    parser.add_argument('--http', type=int, default=1, help='headless multipart HTTP clients')
+    parser.add_argument('--multicast', type=int, default=0,
+                        help='headless clients of the multicast group, over loopback')
+    parser.add_argument('--rendition', default='full')
+    parser.add_argument('--resolution', default='1280x720')
+    parser.add_argument('--fps', type=int, default=60)
+    parser.add_argument('--pattern', default='moving', help='moving, noise, spot or static')
+    parser.add_argument('--tiles', action='store_true',
+                        help='TCP clients ask for keyframes and changed tiles')
+    parser.add_argument('--pipeline', default=None, help='thread or process')
+    parser.add_argument('--encoder', default=None)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--in-process', action='store_true',
+                        help='run the server in this process, its CPU then includes the clients')
+    parser.add_argument('--serve', metavar='JSON', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.serve is not None:
+        return trio.run(server(json.loads(arguments.serve)).run)
+
+    camera = dict(target='synthetic', fps=arguments.fps, synthetic_pattern=arguments.pattern,
+                  resolution=[int(side) for side in arguments.resolution.split('x')])
+    camera.update({key: value for key in ('pipeline', 'encoder')
+                   if (value := getattr(arguments, key)) is not None})
+    overrides = dict(CAMERA=camera)
+
+    if arguments.multicast:
+        overrides['MULTICAST'] = dict(enabled=True, interface=LOOPBACK, rendition=arguments.rendition,
+                                      fps=arguments.fps)
+
+    print(json.dumps(trio.run(benchmark, arguments, overrides), indent=4))
+
+
+if __name__ == '__main__':
+    main()
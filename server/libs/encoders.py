@@ -0,0 +1,134 @@
+import logging
+import sys
+from importlib.util import find_spec
+from io import BytesIO
+from time import perf_counter
+
+import numpy as np
+from cv2 import IMWRITE_JPEG_QUALITY, imencode
+
+if find_spec('PIL'):
+    from PIL import Image
+
+if find_spec('turbojpeg'):
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TurboJPEG
+
+__all__ = ('BufferPool', 'OpenCVEncoder', 'PillowEncoder', 'TurboJPEGEncoder',
+           'ENCODERS', 'select_encoder')
+
+
+class BufferPool:
+    "Hands out output buffers again once no published frame refers to them"
+
+    def __init__(self, limit=16):
+        self._buffers = []
+        self.limit = limit
+
+    def acquire(self, size):
+        for buffer in self._buffers:
+            # The list, the loop variable and the argument are the only owners
+            # once every memoryview of a published frame is gone.
+            if sys.getrefcount(buffer) == 3:
+                if len(buffer) < size:
+                    buffer.extend(bytes(size - len(buffer)))
+                return buffer
+
+        buffer = bytearray(size)
+        if len(self._buffers) < self.limit:
+            self._buffers.append(buffer)
+
+        return buffer
+
+
+class OpenCVEncoder:
+    "imencode allocates its own output, the result is shared without tobytes"
+    name = 'opencv'
+
+    def encode(self, frame, quality):
+        return memoryview(imencode('.jpg', frame, (int(IMWRITE_JPEG_QUALITY), quality))[1])
+
+
+class PillowEncoder:
+    name = 'pillow'
+
+    def __init__(self):
+        if not find_spec('PIL'):
+            raise RuntimeError('Pillow is not installed')
+
+    def encode(self, frame, quality):
+        "Reads the BGR layout of OpenCV and Picamera2 (RGB888) as it is"
+        height, width = frame.shape[:2]
+        image = Image.frombuffer('RGB', (width, height), np.ascontiguousarray(frame),
+                                 'raw', 'BGR', 0, 1)
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=quality)
+
+        return output.getbuffer()
+
+
+class TurboJPEGEncoder:
+    "libjpeg-turbo encoding straight into pooled output buffers"
+    name = 'turbojpeg'
+
+    def __init__(self):
+        if not find_spec('turbojpeg'):
+            raise RuntimeError('PyTurboJPEG is not installed')
+
+        self._turbo = TurboJPEG()
+        self._pool = BufferPool()
+
+    def encode(self, frame, quality):
+        buffer = self._pool.acquire(self._turbo.buffer_size(frame, TJSAMP_420))
+        _, size = self._turbo.encode(frame, quality=quality, pixel_format=TJPF_BGR,
+                                     jpeg_subsample=TJSAMP_420, dst=buffer)
+
+        return memoryview(buffer)[:size]
+
+
+ENCODERS = {encoder.name: encoder for encoder in (OpenCVEncoder, PillowEncoder,
+                                                  TurboJPEGEncoder)}
+
+
+def benchmark(encoder, frame, rounds=10):
+    "Median encode time of the encoder for the given frame"
+    timings = []
+
+    for _ in range(rounds):
+        started = perf_counter()
+        encoder.encode(frame, 80)
+        timings.append(perf_counter() - started)
+
+    return sorted(timings)[len(timings) // 2]
+
+
+def select_encoder(name='auto', resolution=(1280, 720)):
+    "The requested encoder, or the fastest available one for 'auto' or when it cannot encode"
+    if name != 'auto':
+        try:
+            encoder = ENCODERS[name]()
+            # A backend that loads but cannot encode would fail on every frame instead
+            encoder.encode(np.zeros((16, 16, 3), np.uint8), 80)
+
+            return encoder
+        except Exception as error:
+            logging.error('Encoder %s is unusable, selecting another one: %s', name, error)
+
+    width, height = resolution
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    frame = np.random.default_rng(0).integers(0, 64, (height, width, 3), np.uint8)
+    frame += gradient[None, :, None] // 2
+    timings = {}
+
+    for encoder_class in ENCODERS.values():
+        try:
+            encoder = encoder_class()
+            timings[encoder] = benchmark(encoder, frame)
+        except Exception as error:
+            logging.debug('Encoder %s is unavailable: %s', encoder_class.name, error)
+
+    encoder = min(timings, key=timings.get)
+    logging.info('Selected the %s encoder (%s)', encoder.name,
+                 ', '.join(f'{candidate.name}: {timing * 1000:.1f} ms'
+                           for candidate, timing in timings.items()))
+
+    return encoder
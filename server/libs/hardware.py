@@ -0,0 +1,23 @@
+from importlib.util import find_spec
+from time import time
+
+if find_spec('picamera2', package='Picamera2'):
+    from picamera2.outputs import Output
+else:
+    Output = object
+
+__all__ = ('HubOutput', )
+
+
+class HubOutput(Output):
+    "In-memory output of a Picamera2 encoder, every frame goes straight to the hub"
+
+    def __init__(self, hub, resolution):
+        super().__init__()
+        self.hub = hub
+        self.resolution = resolution
+
+    def outputframe(self, frame, *largs, **kwargs):
+        # Encoder timestamps count from the start of the recording, so the
+        # arrival time stands in for the capture time.
+        self.hub.publish(frame, self.resolution, time())
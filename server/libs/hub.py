@@ -0,0 +1,154 @@
+from collections import deque
+from time import perf_counter, time
+from typing import NamedTuple
+
+import trio
+
+from libs.protocol import DELTA, FLAG_DELTA, FLAG_KEYFRAME, pack_header
+
+__all__ = ('Frame', 'FrameHub', 'Subscription')
+
+
+class Frame(NamedTuple):
+    seq: int
+    timestamp: float
+    data: memoryview
+    resolution: tuple
+    header: bytes
+    flags: int = 0
+
+
+class Subscription:
+    "Bounded per-client queue, the oldest frame is dropped when it is full"
+
+    def __init__(self, hub, size=2, controller=None):
+        self._hub = hub
+        self._queue = deque(maxlen=max(1, size))
+        self._ready = trio.Event()
+        self.controller = controller
+        self.dropped = 0
+        self.waited = 0.
+        # Timestamp of the last keyframe handed out, deltas need it on the client
+        self.keyframe = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *largs):
+        self.close()
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def full(self):
+        return len(self._queue) == self._queue.maxlen
+
+    def ready(self, timestamp=None):
+        "Nothing is queued, and the rate controller would let a frame through"
+        return not self._queue and (self.controller is None or timestamp is None
+                                    or self.controller.due(timestamp))
+
+    def put(self, frame: Frame):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+
+        self._queue.append((frame, perf_counter()))
+        self._ready.set()
+
+    async def receive(self) -> Frame:
+        "The oldest queued frame, waited tells how long it sat in the queue"
+        while True:
+            while not self._queue:
+                self._ready = trio.Event()
+                await self._ready.wait()
+
+            frame, queued = self._queue[0]
+
+            # A delta whose keyframe was dropped or never sent gets it first
+            if frame.flags & FLAG_DELTA and (
+                    keyframe := DELTA.unpack_from(frame.data)[0]) != self.keyframe:
+                if self._hub.keyframe is None or self._hub.keyframe.timestamp != keyframe:
+                    # Outdated, a newer keyframe is queued or on its way
+                    self._queue.popleft()
+                    continue
+
+                frame = self._hub.keyframe
+            else:
+                self._queue.popleft()
+
+            if frame.flags & FLAG_KEYFRAME:
+                self.keyframe = frame.timestamp
+
+            self.waited = perf_counter() - queued
+
+            return frame
+
+    def close(self):
+        self._hub.unsubscribe(self)
+
+
+class FrameHub:
+    "Publishes every encoded frame once and fans it out to the subscribers"
+
+    def __init__(self, view=None, tiles=None):
+        self._subscribers = set()
+        self.view = view
+        self.tiles = tiles
+        self.keyframe = None
+        self._token = None
+        self.frame = None
+        self.seq = 0
+
+    def attach(self):
+        "Binds the hub to the running trio loop, call it from within trio"
+        self._token = trio.lowlevel.current_trio_token()
+
+    def publish(self, data, resolution, timestamp=None, flags=0):
+        "Safe to call from the capture thread"
+        self.seq += 1
+        data, timestamp = memoryview(data), timestamp or time()
+        header = pack_header(self.seq, timestamp, data.nbytes, resolution, flags)
+        self.frame = frame = Frame(self.seq, timestamp, data, tuple(resolution),
+                                   header, flags)
+
+        if flags & FLAG_KEYFRAME:
+            self.keyframe = frame
+
+        if self._token is not None and self._subscribers:
+            try:
+                self._token.run_sync_soon(self._dispatch, frame)
+            except trio.RunFinishedError:
+                self._token = None
+
+        return frame
+
+    @property
+    def wanted(self):
+        return bool(self._subscribers)
+
+    def ready(self, timestamp=None):
+        "Whether any subscriber would take a new frame now"
+        return any(subscription.ready(timestamp) for subscription in tuple(self._subscribers))
+
+    def quality(self, default):
+        "The highest quality any rate controller of the subscribers asks for"
+        return max((subscription.controller.quality for subscription in tuple(self._subscribers)
+                    if subscription.controller is not None), default=default)
+
+    def _dispatch(self, frame: Frame):
+        for subscription in tuple(self._subscribers):
+            subscription.put(frame)
+
+    def subscribe(self, size=2, controller=None, latest=False) -> Subscription:
+        "With latest the current frame is queued, so a new viewer does not wait for one"
+        subscription = Subscription(self, size, controller)
+        self._subscribers.add(subscription)
+
+        if latest and self.frame is not None:
+            subscription.put(self.frame)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
@@ -0,0 +1,156 @@
+from bisect import bisect_left
+from math import inf
+
+__all__ = ('Counter', 'Histogram', 'Registry', 'REGISTRY', 'STAGES', 'FRAMES', 'ENCODED',
+           'ENCODED_BYTES', 'SENT', 'SENT_BYTES', 'DROPPED')
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.)
+
+
+def number(value):
+    return '+Inf' if value == inf else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def labelset(labels):
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for value in labels.values())
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    "Running total per combination of label values"
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, *values):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def merge(self, values):
+        for key, amount in values.items():
+            self.inc(amount, *key)
+
+    def samples(self):
+        for key, value in tuple(self.values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram(Counter):
+    "Bucketed durations, only the counts are kept so an observation costs a bisect"
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        if (series := self.values.get(values)) is None:
+            series = self.values[values] = [[0] * (len(self.buckets) + 1), 0.]
+
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def merge(self, values):
+        for key, (counts, total) in values.items():
+            if (series := self.values.get(key)) is None:
+                self.values[key] = [list(counts), total]
+                continue
+
+            series[0] = [count + other for count, other in zip(series[0], counts)]
+            series[1] += total
+
+    def samples(self):
+        for key, (counts, total) in tuple(self.values.items()):
+            labels, cumulative = dict(zip(self.labels, key)), 0
+
+            for bound, count in zip((*self.buckets, inf), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', {**labels, 'le': number(bound)}, cumulative
+
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Callback(Counter):
+    "Values read when scraped, for state that is already kept elsewhere"
+
+    def __init__(self, name, description, labels, function, kind='gauge'):
+        super().__init__(name, description, labels)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        for key, value in self.function():
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Registry:
+    "The metrics of the server, rendered in the Prometheus text format"
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def callback(self, name, description, labels, function, kind='gauge'):
+        return self._add(Callback(name, description, labels, function, kind))
+
+    def drain(self):
+        "Takes the values counted so far, for processes that report to the server"
+        drained = {}
+
+        for name, metric in self.metrics.items():
+            if not isinstance(metric, Callback) and metric.values:
+                drained[name], metric.values = metric.values, {}
+
+        return drained
+
+    def merge(self, drained):
+        for name, values in drained.items():
+            self.metrics[name].merge(values)
+
+    def render(self):
+        lines = []
+
+        for metric in tuple(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labelset(labels)} {number(value)}'
+                         for name, labels, value in metric.samples())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGES = REGISTRY.histogram('lindcam_stage_seconds', 'Time spent in each stage of the frame pipeline',
+                            ('stage', ))
+FRAMES = REGISTRY.counter('lindcam_frames_total', 'Captured frames by what became of them',
+                          ('outcome', ))
+ENCODED = REGISTRY.counter('lindcam_encoded_frames_total', 'Encoded frames per rendition',
+                           ('rendition', ))
+ENCODED_BYTES = REGISTRY.counter('lindcam_encoded_bytes_total', 'Encoded bytes per rendition',
+                                 ('rendition', ))
+SENT = REGISTRY.counter('lindcam_sent_frames_total', 'Frames sent to clients per transport',
+                        ('transport', ))
+SENT_BYTES = REGISTRY.counter('lindcam_sent_bytes_total', 'Bytes sent to clients per transport',
+                              ('transport', ))
+DROPPED = REGISTRY.counter('lindcam_dropped_frames_total',
+                           'Frames a client never got, from a full queue or its rate control',
+                           ('reason', ))
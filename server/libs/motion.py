@@ -0,0 +1,40 @@
+import numpy as np
+
+__all__ = ('ChangeDetector', )
+
+# Luma weights in the BGR order of OpenCV and Picamera2 (RGB888)
+LUMA = np.array((.114, .587, .299), np.float32)
+
+
+class ChangeDetector:
+    "Compares a downsampled grayscale copy of every frame with the last sent one"
+
+    def __init__(self, threshold=2., keyframe_interval=2., step=8):
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.step = step
+        self.difference = 0.
+        self._reference = None
+        self._keyframe = 0.
+
+    def reset(self):
+        self._reference = None
+
+    def changed(self, frame, timestamp):
+        "True when the frame differs enough, or when a keyframe is due"
+        if self.threshold <= 0:
+            return True
+
+        gray = frame[::self.step, ::self.step] @ LUMA
+
+        if self._reference is None or self._reference.shape != gray.shape:
+            self.difference = float('inf')
+        else:
+            self.difference = float(np.abs(gray - self._reference).mean())
+
+        if (self.difference < self.threshold
+                and timestamp - self._keyframe < self.keyframe_interval):
+            return False
+
+        self._reference, self._keyframe = gray, timestamp
+        return True
@@ -0,0 +1,42 @@
+from time import perf_counter, sleep
+
+__all__ = ('FramePacer', )
+
+
+class FramePacer:
+    "When frames are due, by their source timestamps and capped at a frame rate"
+
+    def __init__(self, fps=0, tolerance=.1):
+        self.interval = 1 / fps if fps else 0.
+        self.tolerance = tolerance
+        self.reset()
+
+    def reset(self):
+        "Starts over, for instance when a video loops"
+        self._origin = None
+        self._next = 0.
+
+    def due(self, position=None):
+        "The perf_counter time the frame is due, None when the fps cap skips it"
+        now = perf_counter()
+
+        if position is None:
+            due = max(now, self._next)
+        else:
+            # Anchored at the first frame, and again when it falls a second behind
+            if self._origin is None or now - (self._origin + position) > 1:
+                self._origin = now - position
+            due = self._origin + position
+
+        if due < self._next - self.interval * self.tolerance:
+            return None
+
+        # The next slot follows the previous one, so sleeping does not drift
+        self._next = (self._next if due - self._next < self.interval else due) + self.interval
+
+        return due
+
+    @staticmethod
+    def wait(due):
+        if (delay := due - perf_counter()) > 0:
+            sleep(delay)
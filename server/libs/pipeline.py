@@ -0,0 +1,293 @@
+import logging
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty, Full
+from threading import Thread
+from time import perf_counter, time
+
+import numpy as np
+from libs.metrics import ENCODED, ENCODED_BYTES, REGISTRY, STAGES
+
+__all__ = ('Pipeline', 'SharedRing')
+
+SLOT = np.dtype([('seq', '<i8'), ('timestamp', '<f8'), ('size', '<u8'),
+                 ('width', '<u4'), ('height', '<u4')])
+
+
+class SharedRing:
+    "Fixed slots in shared memory, each one with a small header and its frame data"
+
+    def __init__(self, slots, slot_size):
+        self.slots, self.slot_size = slots, slot_size
+        self._shm = SharedMemory(create=True, size=slots * (SLOT.itemsize + slot_size))
+        self.headers = np.ndarray(slots, SLOT, self._shm.buf)
+        self.data = np.ndarray((slots, slot_size), np.uint8, self._shm.buf,
+                               SLOT.itemsize * slots)
+        self.headers['seq'] = -1
+
+    def __getstate__(self):
+        "Only the name travels to another process, the arrays are mapped again there"
+        return self.slots, self.slot_size, self._shm.name
+
+    def __setstate__(self, state):
+        self.slots, self.slot_size, name = state
+        self._shm = SharedMemory(name)
+        self.headers = np.ndarray(self.slots, SLOT, self._shm.buf)
+        self.data = np.ndarray((self.slots, self.slot_size), np.uint8, self._shm.buf,
+                               SLOT.itemsize * self.slots)
+
+    def write(self, slot, seq, data, timestamp, resolution):
+        "The sequence is cleared while writing, so readers notice torn slots"
+        data = data if isinstance(data, np.ndarray) else np.frombuffer(data, np.uint8)
+
+        if data.nbytes > self.slot_size:
+            return False
+
+        headers = self.headers
+        headers['seq'][slot] = -1
+        self.data[slot, :data.nbytes].reshape(data.shape)[...] = data
+        headers['timestamp'][slot] = timestamp
+        headers['size'][slot] = data.nbytes
+        headers['width'][slot], headers['height'][slot] = resolution
+        headers['seq'][slot] = seq
+
+        return True
+
+    def valid(self, slot, seq):
+        return self.headers['seq'][slot] == seq
+
+    def read(self, slot, seq):
+        "A view of the slot data, None when the slot no longer holds that sequence"
+        if not self.valid(slot, seq):
+            return None
+
+        header = self.headers[slot]
+
+        return (self.data[slot, :header['size']], float(header['timestamp']),
+                (int(header['width']), int(header['height'])))
+
+    def close(self):
+        del self.headers, self.data
+        self._shm.close()
+        self._shm.unlink()
+
+
+class Pipeline:
+    "Capture process, a pool of encoder processes and a publishing thread in the server"
+
+    def __init__(self, device, workers=3, views=4):
+        self.device = device
+        # The processes start from a clean server rather than a fork of its threads and
+        # their locks, so they build a device of their own with the encoder picked here
+        self.factory = type(device)
+        self.settings = {**device.settings, 'encoder': device.encoder.name}
+        self.names = tuple(device.renditions)
+        self._context = mp.get_context('forkserver')
+        # Slots for views of the scene, their crop box and output size are shared
+        self.views = [None] * views
+        self.geometry = self._context.Array('i', views * 6, lock=False)
+        width, height = device.resolution
+        slots, outputs = workers * 2 + 2, len(self.names) + views
+        self.raw = SharedRing(slots, width * height * 3)
+        self.encoded = SharedRing(slots * outputs, width * height)
+        self.control = self._context.Array('i', outputs, lock=False)
+        self.ready = self._context.Array('b', outputs, lock=False)
+        # Lazy encoding depends on how soon the readiness of the clients is seen
+        self._poll = 1 / device.fps / 2 if device.lazy_encoding else .1
+        self.captured = self._context.Queue(slots)
+        self.published = self._context.Queue()
+        self.metrics = self._context.Queue()
+        self.stopped = self._context.Event()
+        self.processes = [self._context.Process(target=self._capture, daemon=True)]
+        self.processes += [self._context.Process(target=self._encode, daemon=True)
+                           for _ in range(workers)]
+
+        for name, (box, output) in device.views.items():
+            self.assign(name, box, output)
+
+    def __getstate__(self):
+        "What the processes take along, everything but the device and the processes"
+        return {**self.__dict__, 'device': None, 'processes': None}
+
+    def start(self):
+        self._update_control()
+
+        for process in self.processes:
+            process.start()
+
+        Thread(target=self._publish, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def assign(self, name, box, output):
+        "Gives a view one of the slots, False when they are all taken"
+        if None not in self.views:
+            return False
+
+        slot = self.views.index(None)
+        self.geometry[slot * 6:slot * 6 + 6] = [*box, *output]
+        self.views[slot] = name
+
+        return True
+
+    def release(self, name):
+        if name in self.views:
+            self.views[self.views.index(name)] = None
+
+    def _hub(self, index):
+        name = self.names[index] if index < len(self.names) else self.views[index - len(self.names)]
+
+        return None if name is None else self.device.hubs.get(name)
+
+    def _report(self, last, now=None):
+        "Sends what the process counted to the server about once a second"
+        if now is None or now - last >= 1:
+            self.metrics.put(REGISTRY.drain())
+            return now
+
+        return last
+
+    def _update_control(self):
+        "Tells the encoders which renditions are wanted, at what quality and if now"
+        timestamp = time()
+
+        for index in range(len(self.control)):
+            if (hub := self._hub(index)) is None or not hub.wanted:
+                self.control[index] = self.ready[index] = 0
+                continue
+
+            self.control[index] = hub.quality(self.device.quality)
+            self.ready[index] = not self.device.lazy_encoding or hub.ready(timestamp)
+
+    def _device(self):
+        device = self.factory(**self.settings)
+        # Counted while the device was made, as it encodes its first empty frame
+        REGISTRY.drain()
+
+        return device
+
+    def _capture(self):
+        "Runs the capture loop of the device, with raw frames going to the ring"
+        device, seq, reported = self._device(), 0, time()
+
+        def write(frame, everyone=False):
+            nonlocal seq, reported
+            timestamp = time()
+            reported = self._report(reported, timestamp)
+            wanted = tuple(bool(quality) for quality in self.control)
+
+            if not (everyone or (any(self.ready) and device.changed(frame, timestamp, wanted))):
+                return
+
+            seq += 1
+            slot = seq % self.raw.slots
+
+            if not self.raw.write(slot, seq, frame, timestamp, frame.shape[1::-1]):
+                logging.warning('Frame of %s does not fit the configured resolution',
+                                frame.shape[1::-1])
+                return
+
+            try:
+                self.captured.put_nowait((slot, seq))
+            except Full:
+                pass
+
+        def watch():
+            self.stopped.wait()
+            device.is_running = False
+
+        device.compression = write
+        device.is_running = True
+        Thread(target=watch, daemon=True).start()
+        getattr(device, device.target)()
+        self._report(reported)
+
+    def _encode(self):
+        device, reported = self._device(), time()
+
+        while not self.stopped.is_set():
+            reported = self._report(reported, time())
+
+            try:
+                slot, seq = self.captured.get(timeout=.1)
+            except Empty:
+                continue
+
+            if (frame := self.raw.read(slot, seq)) is None:
+                continue
+
+            data, timestamp, (width, height) = frame
+            image = data.reshape(height, width, 3)
+
+            for index in range(len(self.control)):
+                if not (quality := self.control[index]) or not self.ready[index]:
+                    continue
+
+                started = perf_counter()
+                if index < len(self.names):
+                    name = self.names[index]
+                    scaled = device.scale(name, image)
+                else:
+                    view, name = index - len(self.names), 'view'
+                    geometry = self.geometry[view * 6:view * 6 + 6]
+                    scaled = device.crop(f'view{view}', image, geometry[:4], tuple(geometry[4:]))
+                encoded = device.encoder.encode(scaled, quality)
+                STAGES.observe(perf_counter() - started, 'encode')
+                ENCODED.inc(1, name)
+                ENCODED_BYTES.inc(len(encoded), name)
+
+                if not self.raw.valid(slot, seq):
+                    break
+
+                output = slot * len(self.control) + index
+                if self.encoded.write(output, seq, encoded, timestamp, scaled.shape[1::-1]):
+                    self.published.put((output, seq, index))
+
+        self._report(reported)
+
+    def _merge(self):
+        while True:
+            try:
+                REGISTRY.merge(self.metrics.get_nowait())
+            except Empty:
+                return
+
+    def _publish(self):
+        "Copies the finished frames out of the ring into the hubs, newest only"
+        last_seq = [0] * len(self.control)
+
+        while not self.stopped.is_set():
+            self._update_control()
+            self._merge()
+
+            try:
+                output, seq, index = self.published.get(timeout=self._poll)
+            except Empty:
+                continue
+
+            if seq <= last_seq[index] or (frame := self.encoded.read(output, seq)) is None:
+                continue
+
+            data, timestamp, resolution = frame
+            data = data.tobytes()
+
+            # A view slot given to another view since is told apart by its size
+            if (hub := self._hub(index)) is None or (
+                    hub.view is not None and resolution != hub.view[1]):
+                continue
+
+            if self.encoded.valid(output, seq):
+                last_seq[index] = seq
+                hub.publish(data, resolution, timestamp)
+
+        for process in self.processes:
+            process.join(2)
+            if process.is_alive():
+                process.terminate()
+
+        self._merge()
+
+        self.raw.close()
+        self.encoded.close()
+        self.device.frame_reset()
@@ -0,0 +1,83 @@
+from bisect import bisect_right
+from collections import deque
+from typing import NamedTuple
+
+from libs.hub import Frame
+from libs.protocol import pack_header
+
+__all__ = ('PreRoll', )
+
+
+class Entry(NamedTuple):
+    seq: int
+    timestamp: float
+    offset: int
+    size: int
+    resolution: tuple
+
+
+class PreRoll:
+    "The last seconds of encoded frames, copied into one buffer of a fixed size"
+
+    def __init__(self, seconds=30, megabytes=64):
+        self.seconds = seconds
+        self._buffer = bytearray(int(megabytes * (1 << 20)))
+        self._view = memoryview(self._buffer)
+        self._index = deque()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def duration(self):
+        return self._index[-1].timestamp - self._index[0].timestamp if self._index else 0.
+
+    @property
+    def used(self):
+        return sum(entry.size for entry in self._index)
+
+    def append(self, frame: Frame):
+        size, index = frame.data.nbytes, self._index
+
+        if size > len(self._buffer):
+            return
+
+        if self._offset + size > len(self._buffer):
+            # The unused tail holds the oldest frames, they go before wrapping
+            while index and index[0].offset >= self._offset:
+                index.popleft()
+            self._offset = 0
+
+        end = self._offset + size
+        while index and self._offset <= index[0].offset < end:
+            index.popleft()
+
+        while index and index[0].timestamp < frame.timestamp - self.seconds:
+            index.popleft()
+
+        self._view[self._offset:end] = frame.data
+        index.append(Entry(frame.seq, frame.timestamp, self._offset, size, frame.resolution))
+        self._offset = end
+
+    def _read(self, entry):
+        "A copy of the frame, None once its part of the buffer was reused"
+        if not self._index or entry.seq < self._index[0].seq:
+            return None
+
+        data = self._buffer[entry.offset:entry.offset + entry.size]
+
+        return Frame(entry.seq, entry.timestamp, memoryview(data), entry.resolution,
+                     pack_header(entry.seq, entry.timestamp, entry.size, entry.resolution))
+
+    def at(self, timestamp):
+        "The frame shown at the given time, None when it is not buffered"
+        position = bisect_right(self._index, timestamp, key=lambda entry: entry.timestamp)
+
+        return self._read(self._index[position - 1]) if position else None
+
+    def frames(self, start, end):
+        "Yields the frames between the timestamps, skipping the ones overwritten meanwhile"
+        for entry in [entry for entry in self._index if start <= entry.timestamp <= end]:
+            if (frame := self._read(entry)) is not None:
+                yield frame
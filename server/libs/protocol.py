@@ -0,0 +1,222 @@
+"""
+    protocol.py - Framing of the camera stream on the TCP port and over multicast
+    Shared between the server and the clients, keep both copies identical.
+
+    The client opens with a single JSON line (the hello), after which every
+    frame is sent as a fixed header followed by the encoded payload.
+    Clients that send no hello receive bare concatenated JPEGs.
+
+    A tiled stream flags whole JPEGs as keyframes. The delta frames between them
+    carry the timestamp of their keyframe and every tile changed since it, each
+    one a JPEG of its own placed at its pixel position.
+
+    Over UDP multicast the framed message (header and payload) is split into
+    numbered fragments. An XOR parity fragment per group of them lets a receiver
+    rebuild one lost fragment of the group, frames still incomplete are dropped.
+"""
+import json
+from functools import partial
+from struct import Struct
+from typing import NamedTuple
+
+__all__ = ('DELTA', 'FLAG_DELTA', 'FLAG_KEYFRAME', 'FRAGMENT', 'HEADER', 'MAGIC', 'TILE',
+           'VERSION', 'FrameAssembler', 'FrameHeader', 'FrameReader', 'fragments', 'hello',
+           'pack_header', 'pack_tiles', 'parse_hello', 'unpack_tiles')
+
+MAGIC = b'LDCM'
+VERSION = 1
+# magic, version, flags, header size, sequence, capture timestamp,
+# payload size, width, height
+HEADER = Struct('!4sBBHIdIHH')
+FLAG_KEYFRAME = 1
+FLAG_DELTA = 2
+# keyframe timestamp and tile count, followed by x, y and JPEG size per tile
+DELTA = Struct('!dH')
+TILE = Struct('!HHI')
+# magic, version, frame sequence, fragment index, data fragments,
+# fragments per parity group (0 without parity), message size
+FRAGMENT = Struct('!4sBIHHBI')
+
+
+class FrameHeader(NamedTuple):
+    magic: bytes
+    version: int
+    flags: int
+    header_size: int
+    seq: int
+    timestamp: float
+    size: int
+    width: int
+    height: int
+
+
+def pack_header(seq, timestamp, size, resolution, flags=0):
+    return HEADER.pack(MAGIC, VERSION, flags, HEADER.size, seq & 0xFFFFFFFF,
+                       timestamp, size, *resolution)
+
+
+def pack_tiles(keyframe, tiles):
+    "The payload of a delta frame from the x, y and JPEG of each tile"
+    return b''.join((DELTA.pack(keyframe, len(tiles)),
+                     *(TILE.pack(x, y, len(data)) for x, y, data in tiles),
+                     *(data for *_, data in tiles)))
+
+
+def unpack_tiles(payload):
+    "The keyframe timestamp of a delta payload and the x, y and JPEG view of each tile"
+    payload = memoryview(payload)
+    keyframe, count = DELTA.unpack_from(payload)
+    offset, tiles = DELTA.size + TILE.size * count, []
+
+    for index in range(count):
+        x, y, size = TILE.unpack_from(payload, DELTA.size + TILE.size * index)
+        tiles.append((x, y, payload[offset:offset + size]))
+        offset += size
+
+    return keyframe, tiles
+
+
+def hello(**kwargs):
+    return json.dumps({'version': VERSION, **kwargs}).encode() + b'\n'
+
+
+def parse_hello(line):
+    try:
+        request = json.loads(line or b'{}')
+    except ValueError:
+        return {}
+
+    return request if isinstance(request, dict) else {}
+
+
+class FrameReader:
+    "Reassembles frames from the stream inside one preallocated buffer"
+
+    def __init__(self, size=1 << 20):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0
+
+    def _reserve(self, size):
+        pending = self._end - self._start
+
+        if pending + size > len(self._buffer):
+            buffer = bytearray(max(pending + size, len(self._buffer) * 2))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+        elif self._end + size > len(self._buffer):
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            return
+
+        self._start, self._end = 0, pending
+
+    def feed(self, data):
+        "Payloads handed out earlier are only valid until the next feed"
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        "Yields the header and a memoryview of the payload of every complete frame"
+        while self._end - self._start >= HEADER.size:
+            header = FrameHeader._make(HEADER.unpack_from(self._buffer, self._start))
+
+            if header.magic != MAGIC or header.version != VERSION:
+                raise ValueError(f'Unsupported frame header: {header}')
+
+            start = self._start + header.header_size
+            end = start + header.size
+
+            if end > self._end:
+                return
+
+            self._start = end
+            yield header, self._view[start:end]
+
+
+def xor(chunks, size):
+    "The XOR of the chunks, the shorter ones padded with zeros to the size"
+    value = 0
+
+    for chunk in chunks:
+        value ^= int.from_bytes(chunk, 'big') << 8 * (size - len(chunk))
+
+    return value.to_bytes(size, 'big')
+
+
+def fragments(seq, message, size=1200, group=0):
+    "The datagrams of a framed message, with a parity fragment after every group"
+    message = memoryview(message)
+    count = -(-len(message) // size)
+    chunks = [message[index * size:(index + 1) * size] for index in range(count)]
+    header = partial(FRAGMENT.pack, MAGIC, VERSION, seq & 0xFFFFFFFF)
+
+    for index, chunk in enumerate(chunks):
+        yield header(index, count, group, len(message)) + chunk
+
+        if group and ((index + 1) % group == 0 or index + 1 == count):
+            first = index // group * group
+            yield header(count + index // group, count, group, len(message)) + xor(
+                chunks[first:index + 1], size)
+
+
+class FrameAssembler:
+    "Puts frames together from their fragments, in any order and with one loss per group"
+
+    def __init__(self, pending=4):
+        self.pending = pending
+        self.dropped = 0
+        self._frames = {}
+        self._last = None
+
+    def feed(self, datagram):
+        "The header and payload of the frame the datagram completes, None until then"
+        if len(datagram) <= FRAGMENT.size:
+            return None
+
+        magic, version, seq, index, count, group, size = FRAGMENT.unpack_from(datagram)
+
+        # Late fragments of frames that are done with, a restarted server starts over
+        if magic != MAGIC or version != VERSION or (
+                self._last is not None and 0 <= self._last - seq < 1024):
+            return None
+
+        if (frame := self._frames.get(seq)) is None:
+            if len(self._frames) >= self.pending:
+                del self._frames[min(self._frames)]
+                self.dropped += 1
+            frame = self._frames[seq] = {}
+
+        frame[index] = memoryview(datagram)[FRAGMENT.size:]
+
+        # With parity a frame can be complete one fragment short per group
+        if group and len(frame) >= count:
+            self._recover(frame, count, group, size)
+
+        if any(index not in frame for index in range(count)):
+            return None
+
+        message = b''.join(frame[index] for index in range(count))[:size]
+        # Whatever came before it is incomplete for good
+        self.dropped += sum(1 for other in self._frames if other < seq)
+        self._frames = {other: fragments for other, fragments in self._frames.items()
+                        if other > seq}
+        self._last = seq
+        header = FrameHeader._make(HEADER.unpack_from(message))
+
+        return header, memoryview(message)[header.header_size:header.header_size + header.size]
+
+    @staticmethod
+    def _recover(frame, count, group, size):
+        "Rebuilds the one missing fragment of a group from its parity"
+        for first in range(0, count, group):
+            indices = range(first, min(first + group, count))
+            missing = [index for index in indices if index not in frame]
+
+            if len(missing) != 1 or (parity := frame.get(count + first // group)) is None:
+                continue
+
+            chunk = xor([parity, *(frame[index] for index in indices if index != missing[0])],
+                        len(parity))
+            frame[missing[0]] = chunk[:min(len(parity), size - missing[0] * len(parity))]
@@ -0,0 +1,101 @@
+from math import ceil, floor
+
+import trio
+
+__all__ = ('CreditWindow', 'RateController')
+
+
+class RateController:
+    "Per-client AIMD controller for the JPEG quality and the frame interval"
+
+    def __init__(self, fps=30, bitrate=8_000_000, quality=80, min_quality=30,
+                 max_quality=90, min_fps=2, smoothing=.2, source_fps=0):
+        self.target_fps = max(min_fps, fps)
+        self.frame_period = 1 / source_fps if source_fps else 0.
+        self.target_bitrate = bitrate
+        self.quality = quality
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.min_fps = min_fps
+        self.smoothing = smoothing
+        self.interval = 1 / self.target_fps
+        self.send_time = 0.
+        self.bitrate = 0.
+        self.fps = 0.
+        self.skipped = 0
+        self.congested = False
+        self._last_sent = None
+        self._healthy = 0
+
+    def _average(self, average, value):
+        return average + self.smoothing * (value - average)
+
+    def _periods(self, interval, rounding):
+        "The interval in whole frames of the source, part of a frame skips all of it"
+        if not self.frame_period:
+            return interval
+
+        return max(1, rounding(round(interval / self.frame_period, 6))) * self.frame_period
+
+    def due(self, timestamp):
+        return self._last_sent is None or timestamp - self._last_sent >= self.interval * .9
+
+    def admit(self, timestamp):
+        "Skips the frame when it arrives sooner than the current interval allows"
+        if not self.due(timestamp):
+            self.skipped += 1
+            return False
+
+        if self._last_sent is not None and timestamp > self._last_sent:
+            self.fps = self._average(self.fps, 1 / (timestamp - self._last_sent))
+
+        self._last_sent = timestamp
+        return True
+
+    def update(self, send_time, size, backlogged):
+        "Feeds back how long the send took and whether the client queue filled up"
+        self.send_time = self._average(self.send_time, send_time)
+        self.bitrate = self._average(self.bitrate, size * 8 * max(self.fps, self.min_fps))
+        # Only a slow link or client skips frames, too many bits only cost quality
+        slow = send_time > self.interval * .8 or backlogged
+        self.congested = slow or self.bitrate > self.target_bitrate
+
+        if self.congested:
+            self._healthy = 0
+            self.quality = max(self.min_quality, self.quality - (5 if slow else 2))
+            if slow:
+                self.interval = min(1 / self.min_fps, self._periods(self.interval * 1.25, ceil))
+            return
+
+        self._healthy += 1
+        if self._healthy >= self.target_fps // 2:
+            self._healthy = 0
+            self.quality = min(self.max_quality, self.quality + 1)
+            self.interval = max(1 / self.target_fps, self._periods(self.interval * .9, floor))
+
+    def state(self):
+        return dict(quality=self.quality, target_fps=self.target_fps,
+                    fps=round(self.fps, 1), interval=round(self.interval, 4),
+                    send_time=round(self.send_time, 4), bitrate=int(self.bitrate),
+                    skipped=self.skipped, congested=self.congested)
+
+
+class CreditWindow:
+    "Frames a client may be sent before it acknowledges them, slow ones skip the rest"
+
+    def __init__(self, size=2):
+        self.size = max(1, size)
+        self.credits = self.size
+        self._granted = trio.Event()
+
+    def ack(self):
+        "One more frame may be sent, never more than the window"
+        self.credits = min(self.size, self.credits + 1)
+        self._granted.set()
+
+    async def acquire(self):
+        while not self.credits:
+            self._granted = trio.Event()
+            await self._granted.wait()
+
+        self.credits -= 1
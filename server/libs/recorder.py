@@ -0,0 +1,91 @@
+from struct import Struct
+
+__all__ = ('AviWriter', )
+
+CHUNK = Struct('<4sI')
+MAIN_HEADER = Struct('<IIIIIIIIII16x')
+STREAM_HEADER = Struct('<4s4sIHHIIIIIIIIhhhh')
+BITMAP_HEADER = Struct('<IiiHH4sIiiII')
+INDEX_ENTRY = Struct('<4sIII')
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+
+class AviWriter:
+    "Motion JPEG in an AVI container, the encoded frames are stored as they are"
+
+    def __init__(self, path, fps, resolution=(0, 0)):
+        self.path = path
+        self.resolution = tuple(resolution)
+        self.fps = fps
+        self.frames = 0
+        # Never over another recording
+        self._file = open(path, 'xb')
+        self._index = []
+        self._start = None
+        self._write_headers()
+
+    @property
+    def size(self):
+        return self._file.tell()
+
+    def _write_headers(self):
+        width, height = self.resolution
+        main = MAIN_HEADER.pack(round(1e6 / self.fps), 0, 0, AVIF_HASINDEX, self.frames,
+                                0, 1, 0, width, height)
+        stream = STREAM_HEADER.pack(b'vids', b'MJPG', 0, 0, 0, 0, 1000, round(self.fps * 1000), 0,
+                                    self.frames, 0, 0xFFFFFFFF, 0, 0, 0, width, height)
+        bitmap = BITMAP_HEADER.pack(BITMAP_HEADER.size, width, height, 1, 24, b'MJPG',
+                                    width * height * 3, 0, 0, 0, 0)
+        strl = (b'strl' + CHUNK.pack(b'strh', len(stream)) + stream
+                + CHUNK.pack(b'strf', len(bitmap)) + bitmap)
+        hdrl = (b'hdrl' + CHUNK.pack(b'avih', len(main)) + main
+                + CHUNK.pack(b'LIST', len(strl)) + strl)
+
+        self._file.seek(0)
+        self._file.write(CHUNK.pack(b'RIFF', 0) + b'AVI ' + CHUNK.pack(b'LIST', len(hdrl)) + hdrl)
+        self._movi = self._file.tell()
+        self._file.write(CHUNK.pack(b'LIST', 0) + b'movi')
+
+    def _chunk(self, data):
+        size = len(data)
+        self._index.append((self._file.tell() - self._movi - 8, size))
+        self._file.write(CHUNK.pack(b'00dc', size))
+        self._file.write(data)
+
+        if size % 2:
+            self._file.write(b'\0')
+
+    def write(self, data, timestamp, resolution):
+        "Places the frame by its timestamp, gaps are filled with empty (repeat) chunks"
+        if self._start is None:
+            self._start, self.resolution = timestamp, tuple(resolution)
+        elif tuple(resolution) != self.resolution:
+            return
+
+        position = round((timestamp - self._start) * self.fps)
+
+        if position < self.frames:
+            return
+
+        while self.frames < position:
+            self._chunk(b'')
+            self.frames += 1
+
+        self._chunk(data)
+        self.frames += 1
+
+    def close(self):
+        end_of_movi = self._file.tell()
+        self._file.write(CHUNK.pack(b'idx1', len(self._index) * INDEX_ENTRY.size))
+        self._file.write(b''.join(INDEX_ENTRY.pack(b'00dc', AVIIF_KEYFRAME if size else 0,
+                                                   offset, size)
+                                  for offset, size in self._index))
+        end = self._file.tell()
+
+        self._write_headers()
+        self._file.seek(self._movi)
+        self._file.write(CHUNK.pack(b'LIST', end_of_movi - self._movi - 8))
+        self._file.seek(0)
+        self._file.write(CHUNK.pack(b'RIFF', end - 8))
+        self._file.close()
@@ -0,0 +1,98 @@
+from contextlib import contextmanager
+from math import inf
+
+import trio
+
+__all__ = ('SessionRegistry', )
+
+
+class SessionRegistry:
+    "Who keeps the device running: open connections, and leases renewed by heartbeats"
+
+    def __init__(self, start, stop, keep_warm=30., on_change=None):
+        self._start = start
+        self._stop = stop
+        self.keep_warm = keep_warm
+        self.on_change = on_change
+        self.sessions = {}
+        self.running = False
+        self._idle = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, client):
+        return client in self.sessions
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def add(self, client, lease=None):
+        "Adds or renews a session, a lease ends unless it is renewed within its seconds"
+        new = client not in self.sessions
+        expires = trio.current_time() + lease if lease else inf
+        self.sessions[client] = max(self.sessions.get(client, expires), expires)
+        self._idle = None
+
+        if not self.running:
+            self.running = True
+            self._start()
+
+        if new:
+            self._changed()
+
+        return new
+
+    def _drop(self, client):
+        if self.sessions.pop(client, None) is None:
+            return False
+
+        if not self.sessions:
+            self._idle = trio.current_time()
+
+        self._changed()
+
+        return True
+
+    def remove(self, client):
+        removed = self._drop(client)
+        self.expire()
+
+        return removed
+
+    def release(self, client):
+        "Ends a lease, the sessions of connections only end with them"
+        return self.sessions.get(client, inf) < inf and self.remove(client)
+
+    def leases(self):
+        "The leased clients and the seconds left on them"
+        now = trio.current_time()
+
+        return {client: round(expires - now, 1) for client, expires in self.sessions.items()
+                if expires < inf}
+
+    @contextmanager
+    def hold(self, client):
+        self.add(client)
+
+        try:
+            yield
+        finally:
+            self.remove(client)
+
+    def expire(self):
+        "Ends the lapsed leases and stops the device once it has been idle long enough"
+        now = trio.current_time()
+
+        for client in [client for client, expires in self.sessions.items() if expires <= now]:
+            self._drop(client)
+
+        if self.running and not self.sessions and now - self._idle >= self.keep_warm:
+            self.running = False
+            self._stop()
+
+    async def run(self, interval=1.):
+        while True:
+            self.expire()
+            await trio.sleep(interval)
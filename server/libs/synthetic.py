@@ -0,0 +1,50 @@
+import numpy as np
+
+__all__ = ('PATTERNS', 'SyntheticSource')
+
+PATTERNS = ('moving', 'noise', 'spot', 'static')
+
+
+class SyntheticSource:
+    "Generated BGR frames: a sliding test scene, random noise, a still scene or one spot moving"
+
+    def __init__(self, resolution, pattern='moving', speed=4):
+        if pattern not in PATTERNS:
+            raise ValueError(f'Unknown synthetic pattern: {pattern}')
+
+        width, height = resolution
+        self.pattern = pattern
+        self.speed = speed
+        self.index = 0
+        # Twice as wide, the moving pattern is a window sliding over it
+        x = np.arange(width * 2, dtype=np.int32)
+        y = np.arange(height, dtype=np.int32)[:, None]
+        self._scene = np.empty((height, width * 2, 3), np.uint8)
+        self._scene[..., 0] = x * 255 // (width * 2)
+        self._scene[..., 1] = y * 255 // max(1, height - 1)
+        # Diagonal stripes, every pixel changes as they move
+        self._scene[..., 2] = 127.5 + 127 * np.sin(2 * np.pi * (x / 36 + y / 48))
+        self._frame = np.ascontiguousarray(self._scene[:, :width])
+        self._rng = np.random.default_rng(0)
+
+    def read(self):
+        "The next frame, written into the same array every time"
+        frame = self._frame
+
+        if self.pattern == 'noise':
+            frame.reshape(-1)[:] = np.frombuffer(self._rng.bytes(frame.nbytes), np.uint8)
+        elif self.pattern == 'moving':
+            offset = self.index * self.speed % frame.shape[1]
+            frame[...] = self._scene[:, offset:offset + frame.shape[1]]
+        elif self.pattern == 'spot':
+            # A small square crossing the still scene, like someone walking by
+            height, width = frame.shape[:2]
+            side = max(2, height // 4)
+            left = self.index * self.speed % (width - side)
+            top = (height - side) // 2
+            frame[top:top + side] = self._scene[top:top + side, :width]
+            frame[top:top + side, left:left + side] = 255
+
+        self.index += 1
+
+        return frame
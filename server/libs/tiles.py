@@ -0,0 +1,81 @@
+import numpy as np
+from cv2 import COLOR_BGR2GRAY, absdiff, cvtColor
+from libs.protocol import FLAG_DELTA, FLAG_KEYFRAME, pack_tiles
+
+__all__ = ('TileEncoder', 'runs')
+
+
+def runs(flags):
+    "The start and end of every run of true values"
+    start = None
+
+    for index, flag in enumerate((*flags, False)):
+        if flag and start is None:
+            start = index
+        elif not flag and start is not None:
+            yield start, index
+            start = None
+
+
+class TileEncoder:
+    "Keyframes now and then, in between only the tiles that differ from the keyframe"
+
+    def __init__(self, encoder, size=64, threshold=12, keyframe_interval=10., min_pixels=8,
+                 max_share=.5):
+        self.encoder = encoder
+        self.size = size
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.min_pixels = min_pixels
+        self.max_share = max_share
+        self.keyframe = 0.
+        self._size = 0
+        self._reference = None
+        self._dirty = None
+
+    def _key(self, image, gray, quality, timestamp):
+        height, width = gray.shape
+        self._reference, self.keyframe = gray, timestamp
+        self._dirty = np.zeros((-(-height // self.size), -(-width // self.size)), bool)
+        data = self.encoder.encode(image, quality)
+        self._size = len(data)
+
+        return data, FLAG_KEYFRAME
+
+    def encode(self, image, quality, timestamp):
+        "The payload and flags of the frame, the timestamp is the one it is published with"
+        gray = cvtColor(image, COLOR_BGR2GRAY)
+
+        if (self._reference is None or self._reference.shape != gray.shape
+                or timestamp - self.keyframe >= self.keyframe_interval):
+            return self._key(image, gray, quality, timestamp)
+
+        # Pixels that moved past the threshold, counted per tile
+        size, (height, width) = self.size, gray.shape
+        moved = absdiff(gray, self._reference) > self.threshold
+        counts = np.add.reduceat(np.add.reduceat(moved, range(0, height, size), 0, np.int32),
+                                 range(0, width, size), 1)
+        # A tile stays in every delta once it changed, so any one delta patches the keyframe
+        self._dirty |= counts >= self.min_pixels
+
+        if self._dirty.mean() > self.max_share:
+            return self._key(image, gray, quality, timestamp)
+
+        tiles = []
+
+        for row, dirty in enumerate(self._dirty.tolist()):
+            # Neighbouring tiles of a row are one JPEG, each one has its own tables
+            for start, end in runs(dirty):
+                y, x = row * size, start * size
+                data = self.encoder.encode(
+                    np.ascontiguousarray(image[y:y + size, x:end * size]), quality)
+                # Copied out, pooled encoder buffers are reused once released
+                tiles.append((x, y, bytes(data)))
+
+        payload = pack_tiles(self.keyframe, tiles)
+
+        # Past the size of the keyframe a new one costs less than the deltas
+        if len(payload) > self._size:
+            return self._key(image, gray, quality, timestamp)
+
+        return payload, FLAG_DELTA
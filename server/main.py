@@ -1,25 +1,56 @@
 import json
 import logging
 import os
+from contextlib import contextmanager
 from datetime import datetime
+from functools import cached_property
 from importlib.util import find_spec
-from os.path import abspath, dirname, join
+from multiprocessing import set_forkserver_preload
+from os import listdir, makedirs
+from os.path import abspath, basename, dirname, isdir, isfile, join
+from socket import (AF_INET, IP_MULTICAST_IF, IP_MULTICAST_LOOP, IP_MULTICAST_TTL,
+                    IPPROTO_IP, SO_SNDBUF, SOCK_DGRAM, SOL_SOCKET, inet_aton)
 from threading import Thread
+from time import perf_counter, sleep, time
 
 import numpy as np
 import trio
-from cv2 import (CAP_PROP_POS_FRAMES, IMWRITE_JPEG_QUALITY, VideoCapture,
-                 imencode)
-from fastapi import FastAPI, Request, Response
+from cv2 import CAP_PROP_POS_FRAMES, CAP_PROP_POS_MSEC, INTER_AREA, VideoCapture, resize
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from hypercorn.config import Config
 from hypercorn.trio import serve
+from libs.encoders import select_encoder
+from libs.hardware import HubOutput
+from libs.hub import FrameHub
+from libs.metrics import (DROPPED, ENCODED, ENCODED_BYTES, FRAMES, REGISTRY, SENT, SENT_BYTES,
+                          STAGES)
+from libs.motion import ChangeDetector
+from libs.pacing import FramePacer
+from libs.pipeline import Pipeline
+from libs.preroll import PreRoll
+from libs.protocol import FLAG_KEYFRAME, fragments, parse_hello
+from libs.ratecontrol import CreditWindow, RateController
+from libs.recorder import AviWriter
+from libs.sessions import SessionRegistry
+from libs.synthetic import SyntheticSource
+from libs.tiles import TileEncoder
+
+# Views are cropped on a grid, so nearby requests share one encode
+GRID = 80
+# Hubs of tiled streams are named after the rendition or view they tile
+TILED = 'tiles:'
+# Unacknowledged frames a WebSocket client may ask for
+MAX_WINDOW = 8
 
 if SYSTEM_IS_PI := find_spec('picamera2', package='Picamera2'):
     os.environ['LIBCAMERA_LOG_LEVELS'] = '4'
     from libcamera import controls
     from picamera2 import Picamera2
+    from picamera2.encoders import MJPEGEncoder, Quality
 
 SCRIPT_LOCATION = dirname(abspath(__file__))
+RECORDINGS = join(SCRIPT_LOCATION, 'recordings')
 logging.basicConfig(filename=join(SCRIPT_LOCATION, 'logs.txt'), filemode='a',
                     format='%(asctime)s %(levelname)s %(message)s', datefmt='%H:%M:%S',
                     level=logging.INFO)
@@ -32,6 +63,10 @@ config = Config()
 config.bind = [':'.join((SERVER_CONFIG['SERVER']['host'][0],
                          SERVER_CONFIG['SERVER']['http']))]
 app = FastAPI(docs_url=None, redoc_url=None)
+# The processes of the pipeline import this module again, from a fork server that
+# already has the heavy packages loaded
+set_forkserver_preload(['cv2', 'fastapi', 'hypercorn.trio', 'numpy', 'trio',
+                        *(['picamera2'] if SYSTEM_IS_PI else [])])
 
 def log(text, prompt_user, has_arg=None):
     has_arg = f': {has_arg}' if has_arg else ''
@@ -40,17 +75,136 @@ def log(text, prompt_user, has_arg=None):
 
 class Device:
     def __init__(self, **kwargs):
-        for key, value in {**SERVER_CONFIG['CAMERA'], **kwargs}.items():
+        # Kept as they are, the processes of the pipeline make a device of their own from them
+        self.settings = {**SERVER_CONFIG['CAMERA'], **kwargs}
+
+        for key, value in self.settings.items():
             setattr(self, key, value)
 
+        self.is_running = False
+        self.encoder = select_encoder(self.encoder, self.resolution)
+        self.hubs = {name: FrameHub() for name in self.renditions}
+        self.detector = ChangeDetector(self.change_threshold, self.keyframe_interval)
+        self._scaled = {}
+        self._pipeline = None
+        self._wanted = None
+        self._hardware = set()
         self.frame_reset()
 
-        if SYSTEM_IS_PI:
-            self.picam2 = Picamera2()
-            self.picam2.set_logging(logging.ERROR)
+    @cached_property
+    def picam2(self):
+        "Opened on first use, so it lives in the capture process of the pipeline"
+        picam2 = Picamera2(self.camera_num)
+        picam2.set_logging(logging.ERROR)
+
+        return picam2
 
     def frame_reset(self):
-        self.compression(np.zeros((*self.resolution[::-1], 3), np.uint8))
+        self.compression(np.zeros((*self.resolution[::-1], 3), np.uint8), True)
+
+    def rendition(self, name=None):
+        "The hub of a configured rendition, the default one when no name is given"
+        # Clients name renditions, views and tiled streams are only reached through their hubs
+        name = name or self.default_rendition
+
+        return self.hubs.get(name) if isinstance(name, str) and name in self.renditions else None
+
+    def rendition_size(self, name, resolution):
+        scale = self.renditions[name]
+
+        return tuple(max(2, int(side * scale) // 2 * 2) for side in resolution)
+
+    def view(self, roi, size=None):
+        "The name of a cropped and resized part of the scene, None when there is no room"
+        x, y, w, h = (min(max(float(value), 0.), 1.) for value in roi)
+        left, top = min(GRID - 1, int(x * GRID)), min(GRID - 1, int(y * GRID))
+        box = (left, top, max(1, min(GRID - left, round(w * GRID))),
+               max(1, min(GRID - top, round(h * GRID))))
+        cropped = [side * part // GRID for side, part in zip(self.resolution, box[2:])]
+        # Never larger than the crop, the client scales up for free
+        scale = min(1., *(wanted / side for wanted, side in zip(size, cropped))) if size else 1.
+        output = tuple(max(2, int(side * scale) // 2 * 2) for side in cropped)
+        name = 'roi:{},{},{},{}@{}x{}'.format(*box, *output)
+
+        if name not in self.hubs:
+            if self._pipeline is not None and not self._pipeline.assign(name, box, output):
+                return None
+
+            hub = FrameHub((box, output))
+            hub.attach()
+            # Replaced rather than changed, the capture thread may be going through it
+            self.hubs = {**self.hubs, name: hub}
+
+        return name
+
+    def tiled(self, name=None):
+        "The name of the tiled stream of a rendition or view, None in the process pipeline"
+        # Its keyframe is kept between frames, the encoder processes share none
+        if self.pipeline == 'process' and not self.hardware_encoding:
+            return None
+
+        name = name if name in self.hubs else self.default_rendition
+
+        if (tiled := TILED + name) not in self.hubs:
+            hub = FrameHub(self.hubs[name].view,
+                           TileEncoder(self.encoder, self.tile_size, self.tile_threshold,
+                                       self.tile_keyframe_interval))
+            hub.attach()
+            self.hubs = {**self.hubs, tiled: hub}
+
+        return tiled
+
+    def release_view(self, name):
+        "Forgets a view or tiled stream once nobody subscribes to it"
+        if ((hub := self.hubs.get(name)) is None or hub.wanted
+                or (hub.view is None and hub.tiles is None)):
+            return
+
+        self.hubs = {key: hub for key, hub in self.hubs.items() if key != name}
+        self._scaled.pop(name, None)
+
+        if hub.tiles is not None:
+            # The view underneath goes as well, unless someone else watches it
+            self.release_view(name.removeprefix(TILED))
+        elif self._pipeline is not None:
+            self._pipeline.release(name)
+
+    def crop(self, key, frame, box, size):
+        "The part of the frame in the box on the grid, resized into the output array"
+        height, width = frame.shape[:2]
+        left, top, w, h = box
+        part = frame[top * height // GRID:(top + h) * height // GRID,
+                     left * width // GRID:(left + w) * width // GRID]
+        self._scaled[key] = resize(part, size, self._scaled.get(key), interpolation=INTER_AREA)
+
+        return self._scaled[key]
+
+    @property
+    def views(self):
+        return {name: hub.view for name, hub in self.hubs.items() if hub.view is not None}
+
+    def scale(self, name, frame, view=None):
+        "The frame resized to the rendition or view, reusing the previous output array"
+        if view is not None:
+            return self.crop(name, frame, *view)
+
+        size = self.rendition_size(name, frame.shape[1::-1])
+
+        if size == frame.shape[1::-1]:
+            return frame
+
+        self._scaled[name] = resize(frame, size, self._scaled.get(name),
+                                    interpolation=INTER_AREA)
+
+        return self._scaled[name]
+
+    def read(self, capture, *largs):
+        "A frame from the capture function, timed for the metrics"
+        started = perf_counter()
+        frame = capture(*largs)
+        STAGES.observe(perf_counter() - started, 'capture')
+
+        return frame
 
     def start(self):
         "Starts the feed of chosen device (camera or video)"
@@ -58,15 +212,34 @@ class Device:
 
         if callable(target):
             self.is_running = True
-            Thread(target=target, daemon=True).start()
-            log('Is now trying stream video.',
-                SERVER_CONFIG['SERVER']['prompt_user'])
+
+            if self.pipeline == 'process' and not self.hardware_encoding:
+                self._pipeline = Pipeline(self, self.encoder_workers, self.max_views)
+                self._pipeline.start()
+            else:
+                Thread(target=target, daemon=True).start()
+
+            log('Is now trying stream video', SERVER_CONFIG['SERVER']['prompt_user'],
+                self.source)
 
     def stop(self):
         self.is_running = False
+        log('Stopped the feed, nobody is listening',
+            SERVER_CONFIG['SERVER']['prompt_user'])
+
+        if self._pipeline is not None:
+            self._pipeline.stop()
+            self._pipeline = None
+
+    @property
+    def hardware_encoding(self):
+        return bool(SYSTEM_IS_PI) and self.target == 'camera' and self.capture_mode == 'video'
 
     def camera(self):
         "Camera-stream directly with a supported camera"
+        if self.hardware_encoding:
+            return self.camera_video()
+
         if SYSTEM_IS_PI:
             config = self.picam2.create_still_configuration(
                 main={'size': self.resolution, 'format': 'RGB888'},
@@ -76,7 +249,7 @@ class Device:
             self.picam2.start()
 
             while self.is_running:
-                self.compression(self.picam2.capture_array())
+                self.compression(self.read(self.picam2.capture_array))
 
             self.picam2.stop()
 
@@ -84,32 +257,127 @@ class Device:
 
         self.video()
 
+    def camera_video(self):
+        "Video mode, the main and lores streams are encoded by the MJPEG encoder"
+        main = next(name for name, scale in self.renditions.items() if scale == 1)
+        lores_size = self.rendition_size(self.lores_rendition, self.resolution)
+        config = self.picam2.create_video_configuration(
+            main={'size': tuple(self.resolution), 'format': 'RGB888'},
+            lores={'size': lores_size, 'format': 'YUV420'},
+            controls={'FrameRate': self.fps, 'AfMode': controls.AfModeEnum.Continuous,
+                      'LensPosition': 3.5})
+        self.picam2.configure(config)
+
+        outputs = ((main, 'main', tuple(self.resolution)),
+                   (self.lores_rendition, 'lores', lores_size))
+        self._hardware.update(name for name, *_ in outputs)
+        encoders = {}
+        self.picam2.start()
+
+        while self.is_running:
+            # An encoder only runs while its rendition has subscribers
+            for name, stream, size in outputs:
+                if self.hubs[name].wanted and name not in encoders:
+                    encoders[name] = MJPEGEncoder()
+                    self.picam2.start_encoder(encoders[name], HubOutput(self.hubs[name], size),
+                                              name=stream, quality=Quality.HIGH)
+                elif not self.hubs[name].wanted and name in encoders:
+                    self.picam2.stop_encoder(encoders.pop(name))
+
+            # The rest of the ladder is still encoded in software from main
+            if any(hub.wanted for name, hub in self.hubs.items() if name not in self._hardware):
+                self.compression(self.read(self.picam2.capture_array, 'main'))
+            else:
+                sleep(.1)
+
+        self.picam2.stop_encoder()
+        self.picam2.stop()
+        self._hardware.clear()
+
+        return self.frame_reset()
+
     def video(self):
-        "Stream directly with the use of OpenCV"
-        cap = VideoCapture(self.captureport if self.target == 'camera'
-                           else self.videosource)
+        "Stream directly with the use of OpenCV, a video file at its own pace"
+        cap = VideoCapture(self.videosource if self.target == 'video' else self.captureport)
+        pacer = FramePacer(self.fps)
 
         while cap.isOpened() and self.is_running:
-            ret, frame = cap.read()
+            if not self.read(cap.grab):
+                cap.set(CAP_PROP_POS_FRAMES, 0)
+                pacer.reset()
+                continue
+
+            # A camera paces itself, so its frames are only capped by the fps
+            position = (cap.get(CAP_PROP_POS_MSEC) / 1000 if self.target == 'video'
+                        else perf_counter())
+
+            if (due := pacer.due(position)) is None:
+                continue
+
+            pacer.wait(due)
+            ret, frame = cap.retrieve()
             if ret:
                 self.compression(frame)
-            else:
-                cap.set(CAP_PROP_POS_FRAMES, 0)
 
         self.frame_reset()
 
-    def compression(self, frame):
-        "Compression for transport"
-        quality = max(30, int(np.average(np.linalg.norm(frame) / np.sqrt(3)) / 1000))
-        compressed_img = imencode('.jpg', frame, (int(IMWRITE_JPEG_QUALITY),
-                                                  quality))[1]
-        self.frame = compressed_img.tobytes()
+    def v4l2(self):
+        "The V4L2 device at captureport, also on a Pi next to its own camera"
+        self.video()
+
+    def synthetic(self):
+        "Generated frames at the configured fps, for benchmarks without a camera"
+        source = SyntheticSource(self.resolution, self.synthetic_pattern)
+        pacer = FramePacer(self.fps)
+
+        while self.is_running:
+            pacer.wait(pacer.due())
+            self.compression(self.read(source.read))
+
+        self.frame_reset()
+
+    def changed(self, frame, timestamp, wanted):
+        "Static frames are skipped, unless the wanted renditions changed"
+        if wanted != self._wanted:
+            self._wanted = wanted
+            self.detector.reset()
+
+        started = perf_counter()
+        changed = self.detector.changed(frame, timestamp)
+        STAGES.observe(perf_counter() - started, 'detect')
+        FRAMES.inc(1, 'changed' if changed else 'unchanged')
+
+        return changed
+
+    def compression(self, frame, everyone=False):
+        "Compression for transport, only the renditions someone is subscribed to"
+        timestamp, hubs = time(), self.hubs
+        wanted = tuple(hub.wanted for hub in hubs.values())
+        # Lazily only when a subscriber is ready to take the frame
+        ready = [(name, hub) for name, hub in hubs.items()
+                 if everyone or (name not in self._hardware and hub.wanted
+                                 and (not self.lazy_encoding or hub.ready(timestamp)))]
+
+        if not ready or not (everyone or self.changed(frame, timestamp, wanted)):
+            return
+
+        for name, hub in ready:
+            started = perf_counter()
+            image = self.scale(name.removeprefix(TILED), frame, hub.view)
+            quality = self.quality if everyone else hub.quality(self.quality)
+            data, flags = ((self.encoder.encode(image, quality), 0) if hub.tiles is None
+                           else hub.tiles.encode(image, quality, timestamp))
+            STAGES.observe(perf_counter() - started, 'encode')
+            # Views share one label, there is no end to their names
+            label = name if hub.view is None else 'view' if hub.tiles is None else TILED + 'view'
+            ENCODED.inc(1, label)
+            ENCODED_BYTES.inc(len(data), label)
+            hub.publish(data, image.shape[1::-1], timestamp, flags)
 
 
 class FeedStream:
     def __init__(self, **kwargs):
-        self._active_sessions = 0
-        self.active_addresses = []
+        self.clients = {}
 
         for key, value in {**SERVER_CONFIG['SERVER'], **kwargs}.items():
             setattr(self, key, value)
@@ -117,90 +385,552 @@ class FeedStream:
         log(f'Initializing the socket protocol on port {self.host[1]}',
             self.prompt_user)
 
-        self.first_listener = True
-        self.device = Device()
+        # Every source is a device of its own, the first one is where clients end up by default
+        self.devices = {source: Device(source=source, **settings)
+                        for source, settings in SERVER_CONFIG['SOURCES'].items()}
+        self.sessions = {source: SessionRegistry(device.start, device.stop, self.keep_warm,
+                                                 self.log_sessions)
+                         for source, device in self.devices.items()}
+        self.preroll = PreRoll(SERVER_CONFIG['PREROLL']['seconds'],
+                               SERVER_CONFIG['PREROLL']['megabytes'])
+        self.recording = None
 
     @property
-    def active_sessions(self):
-        return self._active_sessions
+    def device(self):
+        "The default source, the one of pre-roll, recordings and multicast"
+        return next(iter(self.devices.values()))
 
-    @active_sessions.setter
-    def active_sessions(self, value):
-        self._active_sessions = max(0, value)
-
-        if self._active_sessions == 1 and self.first_listener:
-            self.device.start()
-            self.first_listener = False
-
-        if self._active_sessions == 0:
-            self.device.stop()
-            self.first_listener = True
-
-        log('List of active users', self.prompt_user,
-            f"({', '.join(self.active_addresses) or 'None'})")
-
-    @active_sessions.getter  # type: ignore[misc]
+    @property
     def active_sessions(self):
-        return self._active_sessions
+        return sum(map(len, self.sessions.values()))
+
+    def log_sessions(self):
+        users = [f'{user}@{source}' for source, sessions in self.sessions.items()
+                 for user in sessions.sessions]
+        log('List of active users', self.prompt_user, f"({', '.join(users) or 'None'})")
 
     async def run(self):
+        for device in self.devices.values():
+            for hub in device.hubs.values():
+                hub.attach()
+
         async with trio.open_nursery() as nursery:
             self._nursery = nursery
             nursery.start_soon(trio.serve_tcp, self.transmit_data,
                                self.host[1])
             nursery.start_soon(serve, app, config)
+            for sessions in self.sessions.values():
+                nursery.start_soon(sessions.run)
+
+            if self.preroll.seconds:
+                nursery.start_soon(self.record_preroll)
+
+            if SERVER_CONFIG['MULTICAST']['enabled']:
+                nursery.start_soon(self.multicast)
+
+    async def record_preroll(self):
+        "Keeps the camera running and the last seconds of frames in memory"
+        hub = self.device.rendition(SERVER_CONFIG['PREROLL']['rendition'])
+
+        with self.session('pre-roll'), hub.subscribe(self.queue_size) as subscription:
+            while True:
+                self.preroll.append(await subscription.receive())
+
+    async def multicast(self):
+        "Sends every frame once to the multicast group, however many displays listen"
+        settings = SERVER_CONFIG['MULTICAST']
+        hub = self.device.rendition(settings['rendition'])
+        controller = RateController(fps=settings['fps'], quality=self.device.quality,
+                                    source_fps=self.device.fps)
+
+        with (trio.socket.socket(AF_INET, SOCK_DGRAM) as sock, self.session('multicast'),
+              hub.subscribe(1, controller) as subscription):
+            sock.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, settings['ttl'])
+            # Displays on this host get the frames too
+            sock.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, 1)
+            sock.setsockopt(SOL_SOCKET, SO_SNDBUF, 1 << 20)
+            if settings['interface']:
+                sock.setsockopt(IPPROTO_IP, IP_MULTICAST_IF, inet_aton(settings['interface']))
+
+            while True:
+                frame = await subscription.receive()
+                if not controller.admit(frame.timestamp):
+                    continue
+
+                started = trio.current_time()
+                message = b''.join((frame.header, frame.data))
+
+                try:
+                    for datagram in fragments(frame.seq, message, settings['fragment_size'],
+                                              settings['parity']):
+                        await sock.sendto(datagram, tuple(settings['group']))
+                except OSError as error:
+                    log('Could not send to the multicast group', self.prompt_user, error)
+                    await trio.sleep(1)
+                    continue
+
+                STAGES.observe(trio.current_time() - started, 'send')
+                SENT.inc(1, 'multicast')
+                SENT_BYTES.inc(len(message), 'multicast')
+
+    async def record(self, hub, writer, frames=()):
+        "Stores the encoded frames of the hub as they are until its recording is cancelled"
+        limit = SERVER_CONFIG['RECORDING']['max_megabytes'] << 20
+        recording = self.recording
+
+        try:
+            with (recording['scope'], self.session('recorder'),
+                  hub.subscribe(SERVER_CONFIG['RECORDING']['queue_size']) as subscription):
+                for frame in frames:
+                    await trio.to_thread.run_sync(writer.write, frame.data, frame.timestamp,
+                                                  frame.resolution)
+                while writer.size < limit:
+                    frame = await subscription.receive()
+                    await trio.to_thread.run_sync(writer.write, frame.data, frame.timestamp,
+                                                  frame.resolution)
+        finally:
+            with trio.CancelScope(shield=True):
+                await trio.to_thread.run_sync(writer.close)
+            self.recording = None
+            recording['done'].set()
+            log('Recording finished', self.prompt_user, basename(writer.path))
+
+    @contextmanager
+    def session(self, user, source=None):
+        "Keeps the device of the source running while the listener is connected"
+        source = source or self.device.source
+        log('Is now connected and ready to stream', self.prompt_user, f'"{user}" to {source}')
+
+        with self.sessions[source].hold(user):
+            try:
+                yield
+            finally:
+                log('Disconnected user', self.prompt_user, f'"{user}"')
+
+    async def handshake(self, server_stream):
+        "Reads the hello line of the client, older clients send none"
+        request = b''
+
+        with trio.move_on_after(self.hello_timeout):
+            while b'\n' not in request and len(request) < 4096:
+                if not (data := await server_stream.receive_some(4096)):
+                    break
+                request += data
+
+        return parse_hello(request.partition(b'\n')[0]) if b'\n' in request else None
+
+    def view(self, roi, resolution=None, device=None):
+        "The view a client asks for, None when it is malformed or there is no room for it"
+        try:
+            size = tuple(int(side) for side in resolution) if resolution else None
+            if len(roi) != 4 or (size is not None and len(size) != 2):
+                return None
+
+            return (device or self.device).view(roi, size)
+        except (TypeError, ValueError):
+            return None
 
     async def transmit_data(self, server_stream):
         "Streams the cached frames to chosen listener"
         client_ip, client_port = server_stream.socket.getpeername()
         user = f"{client_ip}:{client_port}"
-        self.active_addresses.append(user)
-        self.active_sessions += 1
-        log('Is now connected and ready to stream', self.prompt_user, f'"{user}"')
-        cached_id = None
 
-        while True:
-            try:
-                frame = self.device.frame
-                if cached_id != (frame_id := id(frame)):
-                    await server_stream.send_all(frame)
-                    cached_id = frame_id
-            except (trio.BrokenResourceError, OSError):
-                break
-
-        self.active_addresses.pop(self.active_addresses.index(user))
-        log('Disconnected user', self.prompt_user, f'"{user}"')
-        self.active_sessions -= 1
+        try:
+            request = await self.handshake(server_stream)
+        except (trio.BrokenResourceError, OSError):
+            return
+
+        # The device only starts once the hello tells which source the client wants
+        source = (request or {}).get('source')
+        device = (self.devices.get(source) if isinstance(source, str) else None) or self.device
+
+        with self.session(user, device.source):
+            await self.stream_frames(server_stream, user, request, device)
+
+    async def stream_frames(self, server_stream, user, request, device):
+        try:
+            rendition = (request or {}).get('size')
+            if not rendition or device.rendition(rendition) is None:
+                rendition = device.default_rendition
+            if (roi := (request or {}).get('roi')) is not None:
+                rendition = self.view(roi, request.get('resolution'), device) or rendition
+            if (request or {}).get('tiles'):
+                rendition = device.tiled(rendition) or rendition
+            hub = device.hubs[rendition]
+            rate_control = {**self.rate_control, 'quality': device.quality,
+                            'source_fps': device.fps}
+            if isinstance(fps := (request or {}).get('fps'), (int, float)):
+                rate_control['fps'] = min(fps, rate_control['fps'])
+            controller = RateController(**rate_control)
+            client = self.clients[user] = dict(source=device.source, rendition=rendition,
+                                               controller=controller, bytes=0, subscription=None)
+
+            with hub.subscribe(self.queue_size, controller, latest=True) as subscription:
+                client['subscription'] = subscription
+
+                while True:
+                    frame = await subscription.receive()
+                    STAGES.observe(subscription.waited, 'queue')
+                    # The deltas that follow a keyframe are useless without it
+                    if not controller.admit(frame.timestamp) and not frame.flags & FLAG_KEYFRAME:
+                        continue
+
+                    started = trio.current_time()
+                    if request is not None:
+                        await server_stream.send_all(frame.header)
+                    await server_stream.send_all(frame.data)
+                    send_time = trio.current_time() - started
+                    STAGES.observe(send_time, 'send')
+                    controller.update(send_time, frame.data.nbytes, subscription.full)
+                    client['bytes'] += frame.data.nbytes
+                    SENT.inc(1, 'tcp')
+                    SENT_BYTES.inc(frame.data.nbytes, 'tcp')
+        except (trio.BrokenResourceError, OSError):
+            pass
+        except (TypeError, ValueError, LookupError) as error:
+            # A hello the checks above missed ends its own connection, not the server
+            log('Closed the connection of a malformed hello', self.prompt_user,
+                f'"{user}" {error!r}')
+        finally:
+            if (client := self.clients.pop(user, None)) is not None:
+                DROPPED.inc(client['controller'].skipped, 'rate')
+                if client['subscription'] is not None:
+                    DROPPED.inc(client['subscription'].dropped, 'queue')
+                device.release_view(client['rendition'])
+
+
+def source_device(source=None):
+    "The device of a source, the default one when none is given"
+    if (device := feed.devices.get(source or feed.device.source)) is None:
+        raise HTTPException(404, f'Unknown source: {source}')
+
+    return device
 
 
 @app.get('/frame', responses={200: {'content': {'image/jpeg': {}}}},
          response_class=Response)
-async def frame(_: Request):
-    return Response(content=feed.device.frame, media_type='image/jpeg')
+@app.get('/frame/{source}', responses={200: {'content': {'image/jpeg': {}}}},
+         response_class=Response)
+async def frame(request: Request, source: str | None = None, size: str | None = None,
+                after: int | None = None, at: float | None = None):
+    device = source_device(source)
+
+    if at is not None:
+        # The pre-roll buffer only holds the default source
+        if device is not feed.device:
+            raise HTTPException(404, f'No pre-roll buffer for {source}')
+        if (frame := feed.preroll.at(relative_time(at))) is None:
+            raise HTTPException(404, 'The frame is no longer in the pre-roll buffer')
+        return Response(content=frame.data, media_type='image/jpeg',
+                        headers={'X-Sequence': str(frame.seq), 'X-Timestamp': str(frame.timestamp)})
+
+    if (hub := device.rendition(size)) is None:
+        raise HTTPException(404, f'Unknown rendition: {size}')
+
+    # Long-poll when the client already has the newest frame, otherwise
+    # make sure a rendition nobody subscribes to is not stale
+    if after == hub.frame.seq or (device.is_running and not hub.wanted):
+        with hub.subscribe(1) as subscription, trio.move_on_after(
+                feed.long_poll if after is not None else 1):
+            await subscription.receive()
+
+    frame = hub.frame
+    headers = {'ETag': f'"{frame.seq}-{int(frame.timestamp * 1000)}"',
+               'Cache-Control': 'no-cache', 'X-Sequence': str(frame.seq),
+               'X-Timestamp': str(frame.timestamp)}
+
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=frame.data, media_type='image/jpeg', headers=headers)
+
+
+def relative_time(timestamp):
+    "Zero and negative timestamps count back from now"
+    return timestamp if timestamp > 0 else time() + timestamp
+
+
+def part(frame):
+    return (f'--frame\r\nContent-Type: image/jpeg\r\n'
+            f'Content-Length: {frame.data.nbytes}\r\nX-Sequence: {frame.seq}\r\n'
+            f'X-Timestamp: {frame.timestamp}\r\n\r\n').encode(), frame.data, b'\r\n'
+
+
+class MultipartResponse(StreamingResponse):
+    "A stream of parts that gives its view back however it ends, also before its body starts"
+
+    def __init__(self, content, device, view=None):
+        super().__init__(content, media_type='multipart/x-mixed-replace; boundary=frame')
+        self.device = device
+        self.view = view
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Its subscription goes first, a view is only released once nobody wants it
+            with trio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+            if self.view is not None:
+                self.device.release_view(self.view)
+
+
+async def multipart(device, hub, user):
+    "Every new frame of the hub as one part of a multipart/x-mixed-replace body"
+    with feed.session(user, device.source), hub.subscribe(feed.queue_size) as subscription:
+        try:
+            # A new view has nothing to show until its first frame is encoded
+            frame = hub.frame or await subscription.receive()
+
+            while True:
+                for chunk in part(frame):
+                    yield chunk
+                SENT.inc(1, 'http')
+                SENT_BYTES.inc(frame.data.nbytes, 'http')
+                frame = await subscription.receive()
+                STAGES.observe(subscription.waited, 'queue')
+        finally:
+            DROPPED.inc(subscription.dropped, 'queue')
+            subscription.close()
+
+
+@app.get('/stream', responses={200: {'content': {'multipart/x-mixed-replace': {}}}},
+         response_class=StreamingResponse)
+async def stream(request: Request, size: str | None = None, roi: str | None = None,
+                 resolution: str | None = None, source: str | None = None):
+    "With roi=x,y,w,h (fractions of the scene) and resolution=WxH only that part is sent"
+    device = source_device(source)
+
+    if roi is not None:
+        if (size := feed.view(roi.split(','), resolution and resolution.split('x'),
+                              device)) is None:
+            raise HTTPException(400, f'Unusable region of interest: {roi}')
+        hub = device.hubs[size]
+    elif (hub := device.rendition(size)) is None:
+        raise HTTPException(404, f'Unknown rendition: {size}')
+
+    return MultipartResponse(multipart(device, hub, f'{request.client.host}:{request.client.port}'),
+                             device, size if roi is not None else None)
+
+
+async def acknowledgements(websocket, window, scope):
+    "Gives the window a credit for every {\"ack\": seq} the client sends"
+    while (message := await websocket.receive())['type'] != 'websocket.disconnect':
+        try:
+            if 'ack' in json.loads(message.get('text') or message.get('bytes') or b'{}'):
+                window.ack()
+        except (TypeError, ValueError):
+            continue
+
+    scope.cancel()
+
+
+@app.websocket('/ws')
+async def websocket_stream(websocket: WebSocket, size: str | None = None, roi: str | None = None,
+                           resolution: str | None = None, window: int = 2,
+                           source: str | None = None):
+    "Binary frames with the header of the TCP stream, at most window of them unacknowledged"
+    if (device := feed.devices.get(source or feed.device.source)) is None:
+        return await websocket.close(1008, f'Unknown source: {source}')
+
+    if roi is not None:
+        if (size := feed.view(roi.split(','), resolution and resolution.split('x'),
+                              device)) is None:
+            return await websocket.close(1008, f'Unusable region of interest: {roi}')
+        hub = device.hubs[size]
+    elif (hub := device.rendition(size)) is None:
+        return await websocket.close(1008, f'Unknown rendition: {size}')
+
+    # The view is given back however this ends, a failed accept included
+    try:
+        await websocket.accept()
+        credits = CreditWindow(min(window, MAX_WINDOW))
+
+        # The newest frame only, one that waits for a credit is replaced by the next
+        with (feed.session(f'{websocket.client.host}:{websocket.client.port}', device.source),
+              hub.subscribe(1, latest=True) as subscription):
+            try:
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(acknowledgements, websocket, credits, nursery.cancel_scope)
+
+                    while True:
+                        await credits.acquire()
+                        frame = await subscription.receive()
+                        STAGES.observe(subscription.waited, 'queue')
+                        started = trio.current_time()
+                        await websocket.send_bytes(b''.join((frame.header, frame.data)))
+                        STAGES.observe(trio.current_time() - started, 'send')
+                        SENT.inc(1, 'websocket')
+                        SENT_BYTES.inc(frame.data.nbytes, 'websocket')
+            except (WebSocketDisconnect, OSError):
+                pass
+            finally:
+                DROPPED.inc(subscription.dropped, 'queue')
+                subscription.close()
+    finally:
+        if roi is not None:
+            device.release_view(size)
+
+
+async def clip_parts(start, end):
+    for frame in feed.preroll.frames(start, end):
+        for chunk in part(frame):
+            yield chunk
+
+
+@app.get('/clip', responses={200: {'content': {'multipart/x-mixed-replace': {}}}},
+         response_class=StreamingResponse)
+async def clip(start: float = -10, end: float = 0):
+    "The buffered frames between two timestamps, each part carries its X-Timestamp"
+    return StreamingResponse(clip_parts(relative_time(start), relative_time(end)),
+                             media_type='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.get('/record/start')
+async def record_start(size: str | None = None, preroll: float = 0):
+    "Starts recording the rendition, optionally beginning with buffered seconds"
+    if feed.recording is not None:
+        raise HTTPException(409, f"Already recording {basename(feed.recording['path'])}")
+
+    if (hub := feed.device.rendition(size)) is None:
+        raise HTTPException(404, f'Unknown rendition: {size}')
+
+    makedirs(RECORDINGS, exist_ok=True)
+    name = datetime.now().strftime('LindCam_%d-%m-%Y_%H-%M-%S')
+    path, count = join(RECORDINGS, f'{name}.avi'), 1
+
+    # A second recording within the same second gets a file of its own
+    while isfile(path):
+        count += 1
+        path = join(RECORDINGS, f'{name}_{count}.avi')
+
+    frames = []
+
+    if preroll > 0 and hub is feed.device.rendition(SERVER_CONFIG['PREROLL']['rendition']):
+        frames = list(feed.preroll.frames(time() - preroll, time()))
+
+    # Taken before anything is awaited, so a concurrent start finds it taken
+    feed.recording = dict(scope=trio.CancelScope(), done=trio.Event(), path=path)
+
+    try:
+        writer = AviWriter(path, feed.device.fps)
+    except OSError as error:
+        feed.recording = None
+        raise HTTPException(500, f'Could not create {basename(path)}: {error.strerror}')
+
+    feed._nursery.start_soon(feed.record, hub, writer, frames)
+
+    return dict(recording=basename(path))
+
+
+@app.get('/record/stop')
+async def record_stop():
+    if (recording := feed.recording) is None:
+        raise HTTPException(409, 'Nothing is being recorded')
+
+    recording['scope'].cancel()
+    await recording['done'].wait()
+
+    return dict(recording=basename(recording['path']))
+
+
+@app.get('/recordings')
+async def recordings():
+    return sorted(listdir(RECORDINGS)) if isdir(RECORDINGS) else []
+
+
+@app.get('/recordings/{name}', response_class=FileResponse)
+async def recording(name: str):
+    path = join(RECORDINGS, basename(name))
+
+    if not isfile(path) or (feed.recording is not None and feed.recording['path'] == path):
+        raise HTTPException(404, f'No finished recording called {name}')
+
+    return FileResponse(path, media_type='video/x-msvideo', filename=basename(path))
 
 
 @app.get('/info')
-async def info(_: Request):
-    return dict(quality=feed.device.framequality, target=feed.device.target,
-                resolution=feed.device.resolution)
+@app.get('/info/{source}')
+async def info(_: Request, source: str | None = None):
+    "The default source and what the server does with it, or any other source on its own"
+    device = source_device(source)
+    details = dict(source=device.source, sources=list(feed.devices), quality=device.quality,
+                   target=device.target, resolution=device.resolution,
+                   renditions=device.renditions, running=device.is_running,
+                   leases=feed.sessions[device.source].leases(), views=list(device.views),
+                   clients={user: dict(rendition=client['rendition'],
+                                       **client['controller'].state())
+                            for user, client in feed.clients.items()
+                            if client['source'] == device.source})
+
+    if device is feed.device:
+        details.update(
+            preroll=dict(frames=len(feed.preroll), seconds=round(feed.preroll.duration, 2),
+                         bytes=feed.preroll.used),
+            recording=basename(feed.recording['path']) if feed.recording else None,
+            multicast=(SERVER_CONFIG['MULTICAST']['group']
+                       if SERVER_CONFIG['MULTICAST']['enabled'] else None))
+
+    return details
+
+
+def client_metric(name, description, value, kind='gauge'):
+    "A value of every connected TCP client, read from the clients when scraped"
+    REGISTRY.callback(name, description, ('client', 'source', 'rendition'),
+                      lambda: (((user, client['source'], client['rendition']), value(client))
+                               for user, client in tuple(feed.clients.items())), kind)
+
+
+client_metric('lindcam_client_fps', 'Frames per second sent to each TCP client',
+              lambda client: client['controller'].fps)
+client_metric('lindcam_client_sent_bytes_total', 'Bytes sent to each TCP client',
+              lambda client: client['bytes'], 'counter')
+client_metric('lindcam_client_dropped_frames_total',
+              'Frames dropped from the queue of each TCP client',
+              lambda client: client['subscription'].dropped if client['subscription'] else 0,
+              'counter')
+client_metric('lindcam_client_skipped_frames_total',
+              'Frames skipped by the rate control of each TCP client',
+              lambda client: client['controller'].skipped, 'counter')
+REGISTRY.callback('lindcam_active_sessions', 'Listeners keeping the device running', (),
+                  lambda: (((), feed.active_sessions), ))
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.get('/disconnect')
-async def disconnect(_: Request):
-    feed.active_sessions -= 1
+async def disconnect(request: Request, client: str | None = None, source: str | None = None):
+    "Ends the lease of the client, the feed stays on for everyone else"
+    feed.sessions[source_device(source).source].release(client or request.client.host)
     return 'Connected' if feed.active_sessions else 'Disconnected'
 
 
 @app.get('/connect')
-async def connect(_: Request):
-    feed.active_sessions += 1
+async def connect(request: Request, client: str | None = None, source: str | None = None):
+    "Leases the feed of the source, it ends unless the client sends heartbeats"
+    feed.sessions[source_device(source).source].add(client or request.client.host, feed.lease)
     return 'Connected' if feed.active_sessions else 'Disconnected'
 
 
+@app.get('/heartbeat')
+async def heartbeat(request: Request, client: str | None = None, source: str | None = None):
+    sessions = feed.sessions[source_device(source).source]
+
+    if (client := client or request.client.host) not in sessions.leases():
+        raise HTTPException(404, f'No lease for {client}, connect again')
+
+    sessions.add(client, feed.lease)
+    return dict(lease=feed.lease)
+
+
 @app.get('/information')
 async def information(_: Request):
     return f'Antal lyssnaren: {feed.active_sessions}'
 
 
-feed = FeedStream()
-trio.run(feed.run)
+if __name__ == '__main__':
+    feed = FeedStream()
+    trio.run(feed.run)